@@ -82,14 +82,16 @@ Arguments:
 INDIR: Directory with the input file (<extension/type>).
 OUTDIR: Directory in which all output will be store.
 OUTPREFIX: Prefix for output. The output file will be named <OUTPREFIX>.ET.<flankSize>_<baseSteps>_<fPositive>_<numReps>.bed/txt
-BIGWIGFILE_TEST: Name of the normalized bigWig file of the test sample.
+BIGWIGFILE_TEST: Name of the normalized bigWig file of the test sample. Several test samples can be
+given as a comma-separated list, the control is then read once for all of them and the output
+of a test sample is named <OUTPREFIX>_<BIGWIGFILE_TEST without .bw>.ET.<...>.bed/txt.
 BIGWIGFILE_CONTROL: Name of the normalized bigWig file of the control sample.
 Options:
   -v        enable verbose logging (no effect)
   -h        print this help text
-  -t        number of available threads (no effect)
+  -t        number of available threads (chromosomes processed in parallel)
   -m        amount of memory to be allocated (no effect)
-  -s        path to the edgeTestChXPseq.py script
+  -s        path to the edgeTestChXPseq.py script (coverageChXPseq.py has to be next to it)
   -p        path to the processChXPedgeTest.R script
   -b        take only every Xth base (default: 100)
   -f        minimal fraction of positive differences within a candidate region (default: 0.7)
@@ -97,6 +99,9 @@ Options:
   -l        size of the regions left and right of the border to check (default 100'000)
   -r        do the same as always, but randomize the test set as well (default: off) - NOT VISIBLE IN THE FILE NAME PER SE
 
+-l and -f can be comma-separated lists (e.g. -l 50000,100000 -f 0.6,0.7), all combinations
+are then computed in one run and written to one .txt/.bed pair each.
+
 Dependencies:
 sudo easy_install ngslib
 sudo pip install skidmarks
@@ -214,28 +219,63 @@ require_command Rscript
 require_command ${runsTestScript} 
 
 # checking input
-input_exists ${inputDir}/${inputFile}
+inputFiles=""
+for curInputFile in ${inputFile//,/ }; do
+  input_exists ${inputDir}/${curInputFile}
+  inputFiles="${inputFiles},${inputDir}/${curInputFile}"
+done
+inputFiles=${inputFiles#,}
 input_exists ${inputDir}/${inputFileReference}
 input_exists ${postProcScript}
 
 # run script
-outfileName="${prefix}.ET.${flankSize}_${baseSteps}_${fPositive}_${numReps}"
-command="${runsTestScript} ${inputDir}/${inputFile} ${inputDir}/${inputFileReference} --baseSteps ${baseSteps} --fPositive ${fPositive} --numReps ${numReps} --flankSize ${flankSize}${randomized} > ${outputDir}/${outfileName}.txt"
+settings=""
+for curFlankSize in ${flankSize//,/ }; do
+  for curFPositive in ${fPositive//,/ }; do
+    settings="${settings} ET.${curFlankSize}_${baseSteps}_${curFPositive}_${numReps}"
+  done
+done
+command="${runsTestScript} ${inputFiles} ${inputDir}/${inputFileReference} --baseSteps ${baseSteps} --fPositive ${fPositive} --numReps ${numReps} --flankSize ${flankSize} --processes ${threads}${randomized}"
+if [[ "${inputFile}" == *,* ]]; then
+  # one control versus many tests, one output per test sample (and combination)
+  command="${command} --batch ${outputDir}/${prefix} --sweep ${outputDir}/${prefix}"
+  outfileNames=""
+  for curInputFile in ${inputFile//,/ }; do
+    for setting in ${settings}; do
+      outfileNames="${outfileNames} ${prefix}_${curInputFile//.bw}.${setting}"
+    done
+  done
+elif [[ "${flankSize}${fPositive}" == *,* ]]; then
+  # parameter sweep, one output per combination
+  command="${command} --sweep ${outputDir}/${prefix}"
+  outfileNames=""
+  for setting in ${settings}; do
+    outfileNames="${outfileNames} ${prefix}.${setting}"
+  done
+else
+  outfileName="${prefix}.${settings# }"
+  command="${command} > ${outputDir}/${outfileName}.txt"
+  outfileNames=${outfileName}
+fi
 echo "=== ${me}: Running: ${command}"
 eval $command
 rc=$?
 echo "=== ${me}: Command ended with exit code $rc"
 
-command="Rscript ${postProcScript} ${outputDir}/${outfileName}.txt ${outputDir}/${outfileName}.bed"
-echo "=== ${me}: Running: ${command}"
-eval $command
-rc=$?
-echo "=== ${me}: Command ended with exit code $rc"
+for outfileName in ${outfileNames}; do
+  command="Rscript ${postProcScript} ${outputDir}/${outfileName}.txt ${outputDir}/${outfileName}.bed"
+  echo "=== ${me}: Running: ${command}"
+  eval $command
+  rc=$?
+  echo "=== ${me}: Command ended with exit code $rc"
+done
 #awk -v OFS="\t" -v TST=${inputFile//.bw} -v CNT=${inputFileReference//.bw} '{if ($5 < 0) {print $1,$2,$3,CNT,$5} else {print $1,$2,$3,TST,$5} }' ${outputDir}/${prefix}.RT.${winLen}.txt > ${outputDir}/${prefix}.RT.${winLen}.bed
 
 ## Checking output
-output_exists "${outputDir}/${outfileName}.txt"
-output_exists "${outputDir}/${outfileName}.bed"
+for outfileName in ${outfileNames}; do
+  output_exists "${outputDir}/${outfileName}.txt"
+  output_exists "${outputDir}/${outfileName}.bed"
+done
 
 ## All done.
 echo "=== ${me}: Script done at `date '+%Y-%m-%d %H:%M:%S'`."
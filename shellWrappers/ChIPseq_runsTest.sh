@@ -39,6 +39,7 @@ baseSteps=25
 pCut=0.00001
 diffCut=1
 largeMode=0
+binMode=point
 threads=1
 memory=4
 maxMem=4
@@ -82,21 +83,24 @@ The comparison goes in both directions. For each region, there is an averageDiff
 which equals to mean(coverageInTes)-mean(coverageInControl). All significant differences
 are reported - irrespective of the sign of the comparison.
 Output:
-<OUTPREFIX>.RT.<winLen>_<winType>_<fragSize>_<minFragSize>_<subWins>_<baseSteps>_<pCut>_<diffCut>.txt: chrom, start, end, pValue, averageDifference
-<OUTPREFIX>.RT.<winLen>_<winType>_<fragSize>_<minFragSize>_<subWins>_<baseSteps>_<pCut>_<diffCut>.bed: chrom, start, end, enrichedIn<FileNameWithoutDotBW>, averageDifference 
+<OUTPREFIX>.RT.<winLen>_<winType>_<fragSize>_<minFragSize>_<subWins>_<baseSteps>_<pCut>_<diffCut>_<largeMode>_<binMode>.txt: chrom, start, end, pValue, averageDifference
+<OUTPREFIX>.RT.<winLen>_<winType>_<fragSize>_<minFragSize>_<subWins>_<baseSteps>_<pCut>_<diffCut>_<largeMode>_<binMode>.bed: chrom, start, end, enrichedIn<FileNameWithoutDotBW>, averageDifference 
 Arguments:
 INDIR: Directory with the input file (<extension/type>).
 OUTDIR: Directory in which all output will be store.
-OUTPREFIX: Prefix for output. The output file will be named <OUTPREFIX>.RT.<winLen>_<winType>_<fragSize>_<minFragSize>_<subWins>_<baseSteps>_<pCut>_<diffCut>.bed/txt
-BIGWIGFILE_TEST: Name of the normalized bigWig file of the test sample.
+OUTPREFIX: Prefix for output. The output file will be named <OUTPREFIX>.RT.<winLen>_<winType>_<fragSize>_<minFragSize>_<subWins>_<baseSteps>_<pCut>_<diffCut>_<largeMode>_<binMode>.bed/txt
+BIGWIGFILE_TEST: Name of the normalized bigWig file of the test sample. Several test samples can be
+given as a comma-separated list, the control is then read once for all of them and the output
+of a test sample is named <OUTPREFIX>_<BIGWIGFILE_TEST without .bw>.RT.<...>.bed/txt.
 BIGWIGFILE_CONTROL: Name of the normalized bigWig file of the control sample.
 Options:
   -v        enable verbose logging (no effect)
   -h        print this help text
-  -t        number of available threads (no effect)
+  -t        number of available threads (chromosomes processed in parallel)
   -m        amount of memory to be allocated (per core, in GB)
-  -s        path to the runsTestChXPseq.py script
-  -p        path to the processChXPrunsTest.R script
+  -s        path to the runsTestChXPseq.py script (coverageChXPseq.py has to be next to it)
+  -p        path to the processChXPrunsTest.R script (not used anymore, the regions are
+            joined and written as BED by runsTestChXPseq.py)
   -l        size of the smoothing window (default: 1'000 bp)
   -w        type of the smoothing window (default: flat, i.e. moving average)
   -f        initial fragment size (default: 1'000'000 bp)
@@ -106,10 +110,14 @@ Options:
   -q        cutoff for the P-value (default: 0.00001)
   -c        cutoff for the LFC (default: 1)
   -g        take only every Xth base BEFORE smoothing (default: 0 means take all bases - it's logically the same as 1 but faster)
+  -x        how the Xth bases of -g are taken: point, mean (the mean of the X bases) or zoom
+            (the mean from the zoom levels of the bigWig) (default: point)
+
+-l, -q and -c can be comma-separated lists (e.g. -l 500,1000 -q 0.001,0.00001), all
+combinations are then computed in one run and written to one .txt/.bed pair each.
 
 Dependencies:
 sudo easy_install ngslib
-sudo pip install skidmarks
 __EOF__
 }
 
@@ -160,8 +168,8 @@ remove_if_present () {
 
 ## parse command-line
 
-short_opts='hvt:m:s:p:l:w:f:d:u:b:q:c:g:'
-long_opts='help,verbose,threads,memory,script,postProcScript,winLen,winType,fragSize,minFragSize,subWins,baseSteps,pCut,diffCut,largeMode'
+short_opts='hvt:m:s:p:l:w:f:d:u:b:q:c:g:x:'
+long_opts='help,verbose,threads,memory,script,postProcScript,winLen,winType,fragSize,minFragSize,subWins,baseSteps,pCut,diffCut,largeMode,binMode'
 
 getopt -T > /dev/null
 rc=$?
@@ -195,6 +203,7 @@ while [ $# -gt 0 ]; do
         --pCut|-q)     shift; pCut=$1 ;;
         --diffCut|-c)  shift; diffCut=$1 ;;
         --largeMode|-g) shift; largeMode=$1 ;;
+        --binMode|-x)  shift; binMode=$1 ;;
         --threads|-t)  shift; threads=$1 ;;
         --memory|-m)   shift; memory=$1 ;;	
         --verbose|-v)  verbose="--verbose" ;;
@@ -224,23 +233,48 @@ inputFileReference=$1
 ## main
 echo "=== ${me}: Starting at `date '+%Y-%m-%d %H:%M:%S'`"
 
-require_command Rscript
 require_command ${runsTestScript} 
 
 # checking input
-input_exists ${inputDir}/${inputFile}
+inputFiles=""
+for curInputFile in ${inputFile//,/ }; do
+  input_exists ${inputDir}/${curInputFile}
+  inputFiles="${inputFiles},${inputDir}/${curInputFile}"
+done
+inputFiles=${inputFiles#,}
 input_exists ${inputDir}/${inputFileReference}
-input_exists ${postProcScript}
 
 # run script
-outfileName="${prefix}.RT.${winLen}_${winType}_${fragSize}_${minFragSize}_${subWins}_${baseSteps}_${pCut}_${diffCut}_${largeMode}"
-command="${runsTestScript} ${inputDir}/${inputFile} ${inputDir}/${inputFileReference} ${winLen} ${winType} ${fragSize} ${minFragSize} --subWins ${subWins} --baseSteps ${baseSteps} --pCut ${pCut} --diffCut ${diffCut} --largeMode ${largeMode} > ${outputDir}/${outfileName}.txt"
-echo "=== ${me}: Running: ${command}"
-eval $command
-rc=$?
-echo "=== ${me}: Command ended with exit code $rc"
-
-command="Rscript ${postProcScript} ${outputDir}/${outfileName}.txt ${outputDir}/${outfileName}.bed ${inputFile//.bw} ${inputFileReference//.bw}"
+settings=""
+for curWinLen in ${winLen//,/ }; do
+  for curPCut in ${pCut//,/ }; do
+    for curDiffCut in ${diffCut//,/ }; do
+      settings="${settings} RT.${curWinLen}_${winType}_${fragSize}_${minFragSize}_${subWins}_${baseSteps}_${curPCut}_${curDiffCut}_${largeMode}_${binMode}"
+    done
+  done
+done
+command="${runsTestScript} ${inputFiles} ${inputDir}/${inputFileReference} ${winLen} ${winType} ${fragSize} ${minFragSize} --subWins ${subWins} --baseSteps ${baseSteps} --pCut ${pCut} --diffCut ${diffCut} --largeMode ${largeMode} --binMode ${binMode} --processes ${threads}"
+if [[ "${inputFile}" == *,* ]]; then
+  # one control versus many tests, one output per test sample (and combination)
+  command="${command} --bed ${outputDir}/${prefix}.bed ${inputFile//.bw} ${inputFileReference//.bw} --batch ${outputDir}/${prefix} --sweep ${outputDir}/${prefix}"
+  outfileNames=""
+  for curInputFile in ${inputFile//,/ }; do
+    for setting in ${settings}; do
+      outfileNames="${outfileNames} ${prefix}_${curInputFile//.bw}.${setting}"
+    done
+  done
+elif [[ "${winLen}${pCut}${diffCut}" == *,* ]]; then
+  # parameter sweep, one output per combination
+  command="${command} --bed ${outputDir}/${prefix}.bed ${inputFile//.bw} ${inputFileReference//.bw} --sweep ${outputDir}/${prefix}"
+  outfileNames=""
+  for setting in ${settings}; do
+    outfileNames="${outfileNames} ${prefix}.${setting}"
+  done
+else
+  outfileName="${prefix}.${settings# }"
+  command="${command} --bed ${outputDir}/${outfileName}.bed ${inputFile//.bw} ${inputFileReference//.bw} > ${outputDir}/${outfileName}.txt"
+  outfileNames=${outfileName}
+fi
 echo "=== ${me}: Running: ${command}"
 eval $command
 rc=$?
@@ -248,8 +282,10 @@ echo "=== ${me}: Command ended with exit code $rc"
 #awk -v OFS="\t" -v TST=${inputFile//.bw} -v CNT=${inputFileReference//.bw} '{if ($5 < 0) {print $1,$2,$3,CNT,$5} else {print $1,$2,$3,TST,$5} }' ${outputDir}/${prefix}.RT.${winLen}.txt > ${outputDir}/${prefix}.RT.${winLen}.bed
 
 ## Checking output
-output_exists "${outputDir}/${outfileName}.txt"
-output_exists "${outputDir}/${outfileName}.bed"
+for outfileName in ${outfileNames}; do
+  output_exists "${outputDir}/${outfileName}.txt"
+  output_exists "${outputDir}/${outfileName}.bed"
+done
 
 ## All done.
 echo "=== ${me}: Script done at `date '+%Y-%m-%d %H:%M:%S'`."
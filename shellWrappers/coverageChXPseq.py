@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The coverage part of runsTestChXPseq.py and edgeTestChXPseq.py: reading the bigWigs
+(bigWigConnection with its block and .npy cache), smoothing and the helpers to process
+the chromosomes in parallel. The scripts import it, keep it in the same directory.
+"""
+
+import sys
+
+import wWigIO
+from ngslib import BigWigFile
+try:
+    import pyBigWig
+except ImportError:
+    pyBigWig = None
+import numpy as np
+import collections
+import hashlib
+import math
+import os
+import Queue
+import threading
+import time
+
+# classes and functions
+def clipIntervals(wigs, start, end):
+    """Clip (start, end, value) intervals to [start, end), drop the ones outside."""
+    return [(max(wig[0], start), min(wig[1], end), wig[2]) for wig in wigs
+            if (wig[1] > start) and (wig[0] < end)]
+
+
+def intervalsToArray(starts, ends, values, start, end):
+    """Expand sorted intervals (starts, ends, values) into a coverage array for [start, end),
+    bases without an interval are zero. The gaps and the intervals are filled in one np.repeat."""
+    if starts.size == 0:
+        return np.zeros(end-start)
+    if np.any(starts[1:] < ends[:-1]):
+        # overlapping intervals, the later one wins
+        out = np.zeros(end-start)
+        for a, b, v in zip(starts, ends, values):
+            out[a-start:b-start] = v
+        return out
+    bounds = np.empty(2 * starts.size + 2, dtype=np.int64)
+    bounds[0] = start
+    bounds[1:-1:2] = starts
+    bounds[2:-1:2] = ends
+    bounds[-1] = end
+    fill = np.zeros(2 * starts.size + 1)
+    fill[1::2] = values
+    return np.repeat(fill, np.diff(bounds))
+
+
+def reflectPad(x, winLen):
+    """Extend x by (winLen-1)/2 reflected values on both sides - the part of the padding
+    np.r_[2 * x[0] - x[winLen:1:-1], x, 2 * x[-1] - x[-1:-winLen:-1]] that the centered
+    window reaches."""
+    half = (winLen - 1) // 2
+    ext = np.empty(x.size + 2 * half)
+    ext[half:half+x.size] = x
+    if half > 0:
+        ext[:half] = 2 * x[0] - x[half+1:1:-1]
+        ext[half+x.size:] = 2 * x[-1] - x[-1:-half-1:-1]
+    return ext
+
+
+def movingSum(ext, winLen, out, blockSize=2**14):
+    """Sums of all winLen long windows of ext (out[i] = ext[i:i+winLen].sum()) from cumulative
+    sums. The cumulative sums restart in every block, so the rounding error does not grow
+    with the length of the chromosome."""
+    numOut = ext.size - winLen + 1
+    cums = np.empty(min(numOut, blockSize) + winLen)
+    cums[0] = 0.
+    for blockStart in xrange(0, numOut, blockSize):
+        blockEnd = min(blockStart + blockSize, numOut)
+        segLen = blockEnd - blockStart + winLen - 1
+        np.cumsum(ext[blockStart:blockStart+segLen], out=cums[1:segLen+1])
+        np.subtract(cums[winLen:segLen+1], cums[:segLen+1-winLen], out=out[blockStart:blockEnd])
+    return out
+
+
+def fftConvolveValid(ext, kernel, out):
+    """Convolution of ext and kernel, only the positions where the kernel lies completely
+    within ext (like np.convolve(ext, kernel, mode="valid")), by overlap-add FFT.
+    Values at the level of the FFT rounding error are set to zero."""
+    winLen = kernel.size
+    numOut = ext.size - winLen + 1
+    nfft = 1 << max(16, int(math.ceil(math.log(4 * winLen, 2))))
+    segSize = nfft - winLen + 1
+    kernelFFT = np.fft.rfft(kernel, nfft)
+    out[:] = 0.
+    for segStart in xrange(0, ext.size, segSize):
+        seg = ext[segStart:segStart+segSize]
+        conv = np.fft.irfft(np.fft.rfft(seg, nfft) * kernelFFT, nfft)[:seg.size+winLen-1]
+        # the full convolution starts winLen-1 positions before the first valid one
+        first = segStart - winLen + 1
+        lo = max(first, 0)
+        hi = min(first + conv.size, numOut)
+        if hi > lo:
+            out[lo:hi] += conv[lo-first:hi-first]
+    if ext.size > 0:
+        out[np.abs(out) < 1e-13 * np.abs(ext).max()] = 0.
+    return out
+
+
+def smoothKernel(winLen=147, winType="flat"):
+    """The (odd) window length and the normalized smoothing kernel.
+    return: winLen, kernel"""
+    winLen = int(winLen)
+    if (winLen % 2) == 0:
+        winLen += 1
+    if winType == "flat":
+        kernel = np.ones(winLen, 'd')
+    else:
+        kernel = getattr(np, winType)(winLen)
+    kernel /= kernel.sum()
+    return winLen, kernel
+
+
+def smoothExtended(ext, winLen, kernel, winType="flat", out=None):
+    """Smoothen an array that is already extended by (winLen-1)/2 values on both sides,
+    the result has (winLen-1) values less than ext."""
+    if out is None:
+        out = np.empty(ext.size - winLen + 1)
+    if winType == "flat":
+        movingSum(ext, winLen, out)
+        out /= winLen
+    else:
+        fftConvolveValid(ext, kernel, out)
+    return out
+
+
+def smoothArray(x, winLen=147, winType="flat", out=None):
+    """Smoothen x with a centered window of winLen (made odd) bases, the ends are extended by
+    reflection. flat uses moving sums, hanning, hamming, bartlett and blackman an FFT
+    convolution. The result is written to out if given (which may be x itself)."""
+    winLen, kernel = smoothKernel(winLen, winType)
+    if x.size <= winLen:
+        # too short for the reflection: continue the last value up to winLen+1 bases and
+        # crop the result, so it has the size of x (e.g. chromosomes as short as the window)
+        y = smoothArray(np.r_[x, np.repeat(x[-1], winLen + 1 - x.size)], winLen, winType)[:x.size]
+        if out is None:
+            return y
+        out[:] = y
+        return out
+    return smoothExtended(reflectPad(x, winLen), winLen, kernel, winType, out)
+
+
+# cache files used or written since then are not evicted (workers inherit it)
+runStart = time.time()
+
+
+class bigWigConnection(object):
+    """A bigWig handler. The bigWig is opened once per process and kept open,
+    the intervals of recently fetched blocks are kept in a small LRU cache.
+    With a cacheDir the binned coverage of whole chromosomes is kept on disk
+    (see getCachedBins) and shared by later runs."""
+    def __init__(self, path, blockSize=1000000, maxBlocks=16, cacheDir=None, cacheSize=10e9):
+        self.path = path
+        self.blockSize = blockSize
+        self.maxBlocks = maxBlocks
+        self.cacheDir = cacheDir
+        self.cacheSize = cacheSize
+        self.handles = {}
+        self.zoomHandles = {}
+        self.blocks = collections.OrderedDict()
+        self.cachedBins = {}
+
+    def __getstate__(self):
+        """Open handles and cached blocks are not passed to other processes."""
+        state = self.__dict__.copy()
+        state["handles"] = {}
+        state["zoomHandles"] = {}
+        state["blocks"] = collections.OrderedDict()
+        state["cachedBins"] = {}
+        return state
+
+    def getHandle(self):
+        """Get the open BigWigFile of the current process (opens it on first use)."""
+        pid = os.getpid()
+        if pid not in self.handles:
+            # handles and blocks inherited from a parent process are not used
+            self.handles = {pid: BigWigFile(self.path)}
+            self.blocks = collections.OrderedDict()
+        return self.handles[pid]
+
+    def getZoomHandle(self):
+        """Get the open pyBigWig file of the current process (for the zoom levels)."""
+        pid = os.getpid()
+        if pid not in self.zoomHandles:
+            self.zoomHandles = {pid: pyBigWig.open(self.path)}
+        return self.zoomHandles[pid]
+
+    def close(self):
+        """Close the BigWigFile of the current process."""
+        handle = self.handles.pop(os.getpid(), None)
+        if handle is not None:
+            handle.close()
+        handle = self.zoomHandles.pop(os.getpid(), None)
+        if handle is not None:
+            handle.close()
+        self.blocks.clear()
+
+    def fetchBlock(self, chrom, block):
+        """Get the intervals (start, end, value) within a block (cached)."""
+        key = (chrom, block)
+        if key in self.blocks:
+            wigs = self.blocks.pop(key)
+        else:
+            start = block * self.blockSize
+            wigs = clipIntervals(self.getHandle().fetch(chrom, start, start + self.blockSize),
+                                 start, start + self.blockSize)
+            if len(self.blocks) >= self.maxBlocks:
+                self.blocks.popitem(last=False)
+        self.blocks[key] = wigs
+        return wigs
+
+    def fetch(self, chrom, start, end):
+        """Get the intervals (start, end, value) within [start, end) - like BigWigFile.fetch,
+        but with the open handle and the cached blocks. Large regions bypass the cache."""
+        firstBlock = int(start // self.blockSize)
+        lastBlock = int((end - 1) // self.blockSize)
+        if (lastBlock - firstBlock) >= self.maxBlocks:
+            return clipIntervals(self.getHandle().fetch(chrom, start, end), start, end)
+        out = []
+        for block in xrange(firstBlock, lastBlock + 1, 1):
+            wigs = self.fetchBlock(chrom, block)
+            if block in (firstBlock, lastBlock):
+                wigs = clipIntervals(wigs, start, end)
+            out.extend(wigs)
+        return out
+
+    def getChromSizesWigIO(self):
+        wWigIO.open(self.path)
+        out = wWigIO.getChromSize(self.path)
+        out = dict(zip(out[0], out[1]))
+        wWigIO.close(self.path)
+        return out
+
+    def getChromSizesNGSLIB(self):
+        out = self.getHandle().chromSizes()
+        out = dict(zip(out[0], out[1]))
+        return out
+
+    def smoothCoverageSave(self, covArray, winLen=147, winType="flat", out=None):
+        """Calculate smoothened coverage, see http://www.scipy.org/Cookbook/SignalSmooth.
+        Note that winLen should be an odd integer. winType == flat meand moving average."""
+        x = covArray
+        if x.size < winLen:
+            raise ValueError("Input vector needs to be bigger than window size.")
+        if x.ndim != 1:
+            raise ValueError("Smooth only accepts 1 dimension arrays.")
+        if winType not in ["flat", "hanning", "hamming", "bartlett", "blackman"]:
+            raise ValueError("Valid winTypes are flat, hanning, hamming, bartlett, and blackman.")
+        return smoothArray(x, winLen, winType, out)
+
+    def smoothCoverageFlat(self, covArray, winLen=147, out=None):
+        """Calculate smoothened coverage using moving average.
+        Note that winLen should be an odd integer."""
+        return smoothArray(covArray, winLen, "flat", out)
+
+    def smoothCoverageSpec(self, covArray, winLen=147, winType="blackman", out=None):
+        """Calculate smoothened coverage with a specified window type.
+        Note that winLen should be an odd integer."""
+        return smoothArray(covArray, winLen, winType, out)
+
+    def getRawCoverage(self, chrom, start, end):
+        """Retrieve an array with the genome coverage."""
+        starts, ends, values = self.getIntervalArrays(chrom, start, end)
+        return intervalsToArray(starts, ends, values, start, end)
+
+    def getSmoothCoverage(self, chrom, start, end, winLen=147, winType="flat"):
+        """Retrieve an array with the smoothened genome coverage.
+        CHECK/TODO: one might have to extend the coverage array first"""
+        raw = self.getRawCoverage(chrom, start, end)
+        return smoothArray(raw, winLen, winType, out=raw)
+
+    def getIntervalArrays(self, chrom, start, end):
+        """Retrieve the intervals within [start, end) as arrays (starts, ends, values)."""
+        wigs = self.fetch(chrom, start, end)
+        if not wigs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        wigs = np.array(wigs, dtype=float)
+        return wigs[:, 0].astype(np.int64), wigs[:, 1].astype(np.int64), wigs[:, 2]
+
+    def getBinnedCoverage(self, chrom, start, end, binSize, binMode="point"):
+        """Retrieve an array with one value per bin of <binSize> bases without building the
+        coverage array at base-pair resolution.
+        binMode: point - the coverage at the first base of each bin (same as out[::binSize])
+                 mean - the mean coverage of each bin (bases without coverage count as zero)
+                 zoom - like mean, but taken from the zoom levels of the bigWig (approximate,
+                        needs pyBigWig, otherwise the same as mean)"""
+        binSize = int(binSize)
+        numBins = -(-(end-start) // binSize)
+        binStarts = start + np.arange(numBins, dtype=np.int64) * binSize
+        if binMode == "zoom" and pyBigWig is not None:
+            return self.getZoomMeans(chrom, start, end, binSize)
+        starts, ends, values = self.getIntervalArrays(chrom, start, end)
+        if binMode == "point":
+            out = np.zeros(numBins)
+            idx = np.searchsorted(ends, binStarts, side="right")
+            hit = idx < ends.size
+            hit[hit] = starts[idx[hit]] <= binStarts[hit]
+            out[hit] = values[idx[hit]]
+            return out
+        # bin sums from the parts of the intervals in their first bin, their last bin and the bins
+        # in between (no cumulative sums, bins without coverage stay exactly zero)
+        firstBin = (starts - start) // binSize
+        lastBin = (ends - 1 - start) // binSize
+        headEnd = np.minimum(ends, start + (firstBin + 1) * binSize)
+        out = np.bincount(firstBin, weights=values * (headEnd - starts), minlength=numBins)
+        multi = lastBin > firstBin
+        tailStart = start + lastBin[multi] * binSize
+        out += np.bincount(lastBin[multi], weights=values[multi] * (ends[multi] - tailStart),
+                           minlength=numBins)
+        numInner = lastBin[multi] - firstBin[multi] - 1
+        if numInner.sum() > 0:
+            innerOffset = np.arange(numInner.sum()) - np.repeat(np.cumsum(numInner) - numInner, numInner)
+            innerBins = np.repeat(firstBin[multi] + 1, numInner) + innerOffset
+            out += np.bincount(innerBins, weights=np.repeat(values[multi] * binSize, numInner),
+                               minlength=numBins)
+        out /= np.minimum(binStarts + binSize, end) - binStarts
+        return out
+
+    def getZoomMeans(self, chrom, start, end, binSize):
+        """Mean coverage per bin from the zoom levels of the bigWig (see getBinnedCoverage)."""
+        bw = self.getZoomHandle()
+        chromEnd = min(end, bw.chroms(chrom))
+        numBins = -(-(end-start) // binSize)
+        numFullBins = (chromEnd - start) // binSize
+        out = np.zeros(numBins)
+        if numFullBins > 0:
+            sums = bw.stats(chrom, start, start + numFullBins * binSize, type="sum", nBins=numFullBins)
+            out[:numFullBins] = [x / binSize if x is not None else 0. for x in sums]
+        if start + numFullBins * binSize < chromEnd:
+            rest = bw.stats(chrom, start + numFullBins * binSize, chromEnd, type="sum", nBins=1)[0]
+            out[numFullBins] = rest / (end - start - numFullBins * binSize) if rest is not None else 0.
+        return out
+
+    def getRawCoverageLargeMode(self, chrom, start, end, largeMode=10, binMode="point"):
+        """Retrieve an array with the genome coverage of every largeMode-th base
+        (or the mean per bin, see getBinnedCoverage)."""
+        return self.getBinnedCoverage(chrom, start, end, largeMode, binMode)
+
+    def getSmoothCoverageLargeMode(self, chrom, start, end, winLen=147, winType="flat", largeMode=10):
+        """Retrieve an array with the smoothened genome coverage.
+        CHECK/TODO: one might have to extend the coverage array first"""
+        winLen = int(winLen/largeMode)
+        raw = self.getRawCoverageLargeMode(chrom, start, end, largeMode)
+        return smoothArray(raw, winLen, winType, out=raw)
+
+    def getBins(self, chrom, size, first, last, largeMode=0, binMode="point", useCache=True):
+        """Coverage of the bins [first, last) of a chromosome (bins of largeMode bases,
+        single bases if largeMode is 0)."""
+        if self.cacheDir and useCache:
+            return np.asarray(self.getCachedBins(chrom, size, largeMode, binMode)[first:last], dtype=float)
+        if not largeMode:
+            return self.getRawCoverage(chrom, first, last)
+        return self.getBinnedCoverage(chrom, first*largeMode, min(last*largeMode, size),
+                                      largeMode, binMode)
+
+    def getCachedBins(self, chrom, size, largeMode=0, binMode="point"):
+        """The coverage bins of a whole chromosome as a read-only memory-mapped .npy file in
+        cacheDir, a missing file is written first. The file name has the path and the
+        modification time of the bigWig, the chromosome size and the bins, so changed bigWigs
+        get new files. Coverage values are float32 in the bigWig, so single bases and point
+        bins are stored as float32, mean bins as float64. Using a file updates its
+        modification time, the least recently used files are removed once the cache is
+        larger than cacheSize bytes."""
+        step = int(largeMode) if largeMode else 1
+        mode = binMode if step > 1 else "point"
+        if (chrom, size, step, mode) in self.cachedBins:
+            return self.cachedBins[(chrom, size, step, mode)]
+        name = "%s_%d_%s_%d_%d_%s.npy" % (hashlib.md5(os.path.abspath(self.path)).hexdigest(),
+                                          int(os.path.getmtime(self.path)),
+                                          chrom.replace(os.sep, "_"), size, step, mode)
+        cachePath = os.path.join(self.cacheDir, name)
+        try:
+            os.utime(cachePath, None)
+            bins = np.load(cachePath, mmap_mode="r")
+        except (IOError, OSError):
+            # missing, or removed by another process sharing the cache in the meantime
+            bins = self.writeCachedBins(chrom, size, largeMode, binMode, cachePath)
+        self.evictCache(cachePath)
+        self.cachedBins[(chrom, size, step, mode)] = bins
+        return bins
+
+    def writeCachedBins(self, chrom, size, largeMode, binMode, cachePath):
+        """Write the cache file of getCachedBins. The file is written under a temporary name and
+        opened before it is renamed, so other processes never see a partial file and removing
+        it does not affect the returned memory-map."""
+        print >> sys.stderr, "caching the coverage of %s in %s" % (chrom, cachePath)
+        step = int(largeMode) if largeMode else 1
+        mode = binMode if step > 1 else "point"
+        numBins = -(-size // step)
+        try:
+            os.makedirs(self.cacheDir)
+        except OSError:
+            # already there (maybe created by another process in the meantime)
+            if not os.path.isdir(self.cacheDir):
+                raise
+        tmpPath = "%s.%d.tmp" % (cachePath, os.getpid())
+        out = np.lib.format.open_memmap(tmpPath, mode="w+", shape=(numBins,),
+                                        dtype=np.float32 if mode == "point" else np.float64)
+        for first in xrange(0, numBins, 2**24):
+            last = min(first + 2**24, numBins)
+            out[first:last] = self.getBins(chrom, size, first, last, largeMode, binMode, False)
+        out.flush()
+        del out
+        bins = np.load(tmpPath, mmap_mode="r")
+        os.rename(tmpPath, cachePath)
+        return bins
+
+    def evictCache(self, keep=None):
+        """Remove the least recently used files of cacheDir until it is at most cacheSize bytes.
+        Files used since the start of this run are kept (other workers may be about to open
+        them), the cache can therefore be larger than cacheSize during a run."""
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith(".npy"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cacheDir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(self.cacheDir, name)))
+        total = sum([entry[1] for entry in entries])
+        for mtime, fileSize, path in sorted(entries):
+            if (total <= self.cacheSize) or (mtime >= runStart):
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= fileSize
+        return None
+
+    def iterCoverageTiles(self, chrom, size, tileSize=10000000, winLen=0, winType="flat",
+                          largeMode=0, binMode="point"):
+        """Yield (first bin, coverage) for consecutive tiles of a chromosome. With winLen the
+        coverage is smoothened like getSmoothCoverage(LargeMode) of the whole chromosome:
+        every tile is read with a halo of half a window on both sides and only the chromosome
+        ends are extended by reflection. The tiles are a multiple of the movingSum blocks,
+        so flat windows give exactly the same values. Only about one tile is held in memory.
+        winLen can also be a list, the coverage is then a list with one smoothened tile per
+        window length (the coverage is read once with the largest halo)."""
+        step = int(largeMode) if largeMode else 1
+        numBins = -(-size // step)
+        winLens = winLen if isinstance(winLen, list) else [winLen]
+        kernels = []
+        if winLens[0]:
+            kernels = [smoothKernel(int(curLen/largeMode) if largeMode else curLen, winType)
+                       for curLen in winLens]
+            if numBins <= max([curLen for curLen, kernel in kernels]):
+                raw = self.getBins(chrom, size, 0, numBins, largeMode, binMode)
+                tiles = [smoothArray(raw, curLen, winType) for curLen, kernel in kernels]
+                yield 0, tiles if isinstance(winLen, list) else tiles[0]
+                return
+        halo = max([(curLen - 1) // 2 for curLen, kernel in kernels]) if kernels else 0
+        tileBins = max(1, int(tileSize // step) // 2**14) * 2**14
+        for first in xrange(0, numBins, tileBins):
+            last = min(first + tileBins, numBins)
+            lo = max(first - halo, 0)
+            hi = min(last + halo, numBins)
+            raw = self.getBins(chrom, size, lo, hi, largeMode, binMode)
+            if not kernels:
+                yield first, raw
+                continue
+            # ext[i] is the (reflected) coverage of bin first-halo+i
+            ext = np.empty(last - first + 2*halo)
+            ext[lo-first+halo:hi-first+halo] = raw
+            if lo > first - halo:
+                # 2 * x[0] - x[1-b] for the bins b < 0 (as reflectPad)
+                bins = np.arange(first - halo, 0)
+                ext[:lo-first+halo] = 2 * raw[0] - raw[1-bins-lo]
+            if hi < last + halo:
+                # 2 * x[-1] - x[2*numBins-1-b] for the bins b >= numBins
+                bins = np.arange(numBins, last + halo)
+                ext[hi-first+halo:] = 2 * raw[-1] - raw[2*numBins-1-bins-lo]
+            # a smaller window needs only the inner part of the halo
+            tiles = [smoothExtended(ext[halo-(curLen-1)//2:ext.size-halo+(curLen-1)//2],
+                                    curLen, kernel, winType) for curLen, kernel in kernels]
+            yield first, tiles if isinstance(winLen, list) else tiles[0]
+
+    def getTiledCoverage(self, chrom, size, tileSize=10000000, winLen=0, winType="flat",
+                         largeMode=0, binMode="point"):
+        """The coverage of a whole chromosome, read tile by tile (see iterCoverageTiles)."""
+        numBins = -(-size // int(largeMode)) if largeMode else size
+        out = np.empty(numBins)
+        end = 0
+        for first, tile in self.iterCoverageTiles(chrom, size, tileSize, winLen, winType,
+                                                  largeMode, binMode):
+            out[first:first+tile.size] = tile
+            end = first + tile.size
+        if end != numBins:
+            raise ValueError("Got %d of the %d coverage bins of %s." % (end, numBins, chrom))
+        return out
+
+
+def prefetch(items, depth=1):
+    """Iterate over items while a background thread already produces the next <depth> ones,
+    e.g. reads and decodes the coverage of the next tile (or chromosome) while the current one is tested.
+    The bounded queue caps the memory, depth=0 iterates without a thread. Exceptions of
+    the thread are raised here, and the thread is stopped when the iteration ends."""
+    if depth < 1:
+        for item in items:
+            yield item
+        return
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except:
+            put((False, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            more, item = queue.get()
+            if not more:
+                if item is not None:
+                    raise item[0], item[1], item[2]
+                return
+            yield item
+    finally:
+        # the thread may still use the bigWigConnections, wait for it
+        stop.set()
+        thread.join()
+
+
+def sampleName(path):
+    """The name of a sample in file names: the name of its bigWig without .bw"""
+    return os.path.basename(path).replace(".bw", "")
+
+
+def inChromOrder(results, chroms):
+    """Yield the (chrom, result) pairs in the order of chroms, no matter in which order they arrive."""
+    pending = {}
+    i = 0
+    for chrom, result in results:
+        pending[chrom] = result
+        while (i < len(chroms)) and (chroms[i] in pending):
+            yield chroms[i], pending.pop(chroms[i])
+            i += 1
@@ -11,15 +11,37 @@ btw - this is for deeptools:
 sudo pip install pyBigWig
 
 arguments:
-\t-bwTest: bigWig of the test sample
+\t-bwTest: bigWig of the test sample (a comma-separated list with --batch)
 \t-bwControl: bigWig of the control sample
 
 optional arguments:
 \t--baseSteps: take only every Xth base (default: 100)
+\t--binMode: point (the coverage of every Xth base), mean (the mean coverage of the X bases)
+\t\tor zoom (the mean taken from the zoom levels of the bigWig, needs pyBigWig) (default: point)
 \t--fPositive: minimal fraction of positive differences within a candidate region (default: 0.7)
 \t--numReps: number of random sets (default: 5)
 \t--flankSize: size of the regions left and right of the border to check (default 100'000)
 \t--randomized: do the same as always, but randomize the test set as well (default: off)
+\t--seed: seed for the random sets, makes the border threshold reproducible (default: random)
+\t--permBatch: number of random sets scored at once (default: as many as fit into ~20 million values)
+\t--permProcesses: number of processes scoring the random sets (default: 1, ignored with --processes)
+\t--processes: number of chromosomes processed in parallel, largest first (default: 1)
+\t\tthe output is written in the order of the chromosome names
+\t--tileSize: the coverage is read in tiles of about this many bases (default: 10'000'000)
+\t--cacheDir: keep the binned coverage of the bigWigs in this directory, later runs with the
+\t\tsame bigWigs and --baseSteps/--binMode read it from there (default: no cache)
+\t--cacheSize: maximal size of the cache directory in GB (default: 10)
+\t--prefetch: number of chromosomes whose coverage a background thread reads ahead while the
+\t\tcurrent one is tested, without --processes (default: 1, 0 reads a chromosome only when needed)
+\t--sweep outPrefix: --flankSize and --fPositive can be comma-separated lists, every combination
+\t\tis written to <outPrefix>.ET.<flankSize>_<baseSteps>_<fPositive>_<numReps>.txt; the coverage,
+\t\tthe differences and the random sets are computed once for all of them (without --sweep
+\t\tonly the first values are used)
+\t--batch outPrefix: bwTest is a comma-separated list of test samples that are all compared to
+\t\tbwControl, the control coverage is read once per chromosome and the differences of all
+\t\tsamples are computed together. The results of a sample go to <outPrefix>_<sample>.ET.
+\t\t<flankSize>_<baseSteps>_<fPositive>_<numReps>.txt (for every combination with --sweep),
+\t\t<sample> is the file name without .bw
 
 notes:
 \t-the regions should not be overlapping anymore
@@ -33,25 +55,46 @@ http://www.nature.com/nature/journal/v453/n7197/full/nature06947.html#online-met
 import sys
 
 try:
-    bwTest = sys.argv[1]
+    bwTests = sys.argv[1].split(",")
+    bwTest = bwTests[0]
     bwControl = sys.argv[2]
 except:
     print >> sys.stderr, __doc__
     sys.exit(1)
 
-fPositive = float(sys.argv[sys.argv.index("--fPositive")+1]) if "--fPositive" in sys.argv else float(0.7)
+fPositives = [float(x) for x in sys.argv[sys.argv.index("--fPositive")+1].split(",")] if "--fPositive" in sys.argv else [float(0.7)]
+fPositive = fPositives[0]
 numReps = int(sys.argv[sys.argv.index("--numReps")+1]) if "--numReps" in sys.argv else 5
 baseSteps = int(sys.argv[sys.argv.index("--baseSteps")+1]) if "--baseSteps" in sys.argv else 100
-flankSize = int(sys.argv[sys.argv.index("--flankSize")+1]) if "--flankSize" in sys.argv else 1e5
+flankSizes = [int(x) for x in sys.argv[sys.argv.index("--flankSize")+1].split(",")] if "--flankSize" in sys.argv else [1e5]
+flankSize = flankSizes[0]
+sweepPrefix = sys.argv[sys.argv.index("--sweep")+1] if "--sweep" in sys.argv else None
+batchPrefix = sys.argv[sys.argv.index("--batch")+1] if "--batch" in sys.argv else None
+if batchPrefix is None:
+    bwTests = bwTests[:1]
+if sweepPrefix is None:
+    fPositives = fPositives[:1]
+    flankSizes = flankSizes[:1]
 randomized = "--randomized" in sys.argv
+binMode = sys.argv[sys.argv.index("--binMode")+1] if "--binMode" in sys.argv else "point"
+PERM_SEED = int(sys.argv[sys.argv.index("--seed")+1]) if "--seed" in sys.argv else None
+PERM_BATCH = int(sys.argv[sys.argv.index("--permBatch")+1]) if "--permBatch" in sys.argv else 0
+permProcesses = int(sys.argv[sys.argv.index("--permProcesses")+1]) if "--permProcesses" in sys.argv else 1
+processes = int(sys.argv[sys.argv.index("--processes")+1]) if "--processes" in sys.argv else 1
+tileSize = int(sys.argv[sys.argv.index("--tileSize")+1]) if "--tileSize" in sys.argv else int(1e7)
+cacheDir = sys.argv[sys.argv.index("--cacheDir")+1] if "--cacheDir" in sys.argv else None
+cacheSize = float(sys.argv[sys.argv.index("--cacheSize")+1])*1e9 if "--cacheSize" in sys.argv else 10e9
+prefetchDepth = int(sys.argv[sys.argv.index("--prefetch")+1]) if "--prefetch" in sys.argv else 1
 
 GLOBAL_LEFT_RIGHT=int(flankSize/baseSteps)
 
-import wWigIO
-from ngslib import BigWigFile
+from coverageChXPseq import bigWigConnection, prefetch, sampleName, inChromOrder
 from skidmarks import wald_wolfowitz, serial_test
 import numpy as np
+import itertools
 import math
+import multiprocessing
+import zlib
 import random
 
 # classes and functions
@@ -74,7 +117,30 @@ def sign01(x):
     else:
         return 0
 
-sign01vec = np.vectorize(sign01)
+def sign01vec(x):
+    """sign01 for arrays (1 for positive values and +0, 0 for negative values, -0 and nan)."""
+    x = np.asarray(x)
+    return ((x > 0) | ((x == 0) & ~np.signbit(x))).astype(np.int8)
+
+
+def cumulativeSums(diff):
+    """The cumulative sum with a leading zero (along the last axis)."""
+    cs = np.zeros(diff.shape[:-1] + (diff.shape[-1] + 1,), dtype=np.int64)
+    np.cumsum(diff, axis=-1, out=cs[..., 1:])
+    return cs
+
+
+def windowSums(diff, flank, cs=None):
+    """Sum of the <flank> values left and right of every midpoint in [flank, size-flank),
+    computed from the cumulative sum (along the last axis, so 2-D arrays work row by row).
+    cs: the cumulativeSums of diff if they are already known (e.g. for several flanks)
+    return: left, right"""
+    size = diff.shape[-1]
+    if cs is None:
+        cs = cumulativeSums(diff)
+    left = cs[..., flank:size-flank] - cs[..., 0:size-2*flank]
+    right = cs[..., 2*flank:size] - cs[..., flank:size-flank]
+    return left, right
 
 def negZeroPos(x):
     """Like a sign function but returning -1, 0 and 1. It's actually cmp(x, 0)."""
@@ -82,6 +148,24 @@ def negZeroPos(x):
 
 negZeroPosVec = np.vectorize(negZeroPos)
 
+
+def permutationPercentiles(args):
+    """Score a batch of random sets. Each set is a shuffle of the 0/1 vector with its own
+    random stream (seeds are lists of ints for np.random.RandomState). The random sets and
+    their cumulative sums are shared by all flanks.
+    return: the 99th percentile of the border values of each set (a row per flank)"""
+    diff, flanks, seeds = args
+    batch = np.empty((len(seeds), diff.size), dtype=diff.dtype)
+    for i, seed in enumerate(seeds):
+        batch[i] = diff
+        np.random.RandomState(seed).shuffle(batch[i])
+    cs = cumulativeSums(batch)
+    out = np.empty((len(flanks), len(seeds)))
+    for i, flank in enumerate(flanks):
+        lef, rig = windowSums(batch, flank, cs)
+        out[i] = np.percentile(np.abs(lef-rig), 99, axis=1)
+    return out
+
 class genomicRegion(object):
     """A genomic region with chrom, start, end, values for the borders and
     the fraction of positive differences. Just for printing."""
@@ -135,16 +219,16 @@ class chromosome(object):
                                                       winLen, winType)
         return None
 
-    def addRawContCovLargeMode(self, bwConnection):
+    def addRawContCovLargeMode(self, bwConnection, binMode="point"):
         """Add the control coverage given a bigWigConnection."""
         self.contCov = bwConnection.getRawCoverageLargeMode(self.chrom, self.start, self.end,
-                                                            self.baseStep)
+                                                            self.baseStep, binMode)
         return None
 
-    def addRawTestCovLargeMode(self, bwConnection):
+    def addRawTestCovLargeMode(self, bwConnection, binMode="point"):
         """Add the test coverage given a bigWigConnection."""
         self.testCov = bwConnection.getRawCoverageLargeMode(self.chrom, self.start, self.end,
-                                                            self.baseStep)
+                                                            self.baseStep, binMode)
         return None
 
     def addSmoothContCovLargeMode(self, bwConnection, winLen=1e5, winType="flat"):
@@ -159,22 +243,24 @@ class chromosome(object):
                                                       winLen, winType, self.baseStep)
         return None
 
-    def getBorders(self, floatDiff, threshold, randomized=False):
-        """Identify edges in a vector of differences."""
+    def getBorders(self, floatDiff, threshold, randomized=False, flank=None, cs=None):
+        """Identify edges in a vector of differences.
+        flank: number of values left and right of the border (default: GLOBAL_LEFT_RIGHT)
+        cs: the cumulativeSums of the signs of floatDiff if they are already known"""
+        if flank is None:
+            flank = GLOBAL_LEFT_RIGHT
         out = {"MP":[], "BT":[], "SC":[], "SKIP":False}
         diff = sign01vec(floatDiff)
         #diff = negZeroPosVec(floatDiff)
         if randomized:
             np.random.shuffle(diff)
-        for midPoint in xrange(GLOBAL_LEFT_RIGHT, diff.size-GLOBAL_LEFT_RIGHT, 1):
-            lef = np.sum(diff[(midPoint-GLOBAL_LEFT_RIGHT):midPoint])
-            rig = np.sum(diff[midPoint:(midPoint+GLOBAL_LEFT_RIGHT)])
-            if abs(lef-rig) < threshold:
-                continue
-            BT = "LB" if lef < rig else "RB"
-            out["SC"].append(abs(lef-rig))
-            out["MP"].append(midPoint)
-            out["BT"].append(BT)
+            cs = None
+        lef, rig = windowSums(diff, flank, cs)
+        score = np.abs(lef-rig)
+        keep = np.flatnonzero(score >= threshold)
+        out["SC"] = score[keep].tolist()
+        out["MP"] = (keep + flank).tolist()
+        out["BT"] = np.where(lef[keep] < rig[keep], "LB", "RB").tolist()
         numLB = sum([x=="LB" for x in out["BT"]])
         numRB = sum([x=="RB" for x in out["BT"]])
         print >> sys.stderr, "Identified %d left and %d right borders." % (numLB, numRB)
@@ -182,39 +268,87 @@ class chromosome(object):
             out["SKIP"] = True
         return out
 
-    def getBorderThreshold(self, floatDiff, numRep=10):
-        """Shuffle everything <numRep> times and get the distribution for the border values."""
+    def getBorderThreshold(self, floatDiff, numRep=10, pool=None, flanks=None):
+        """Shuffle everything <numRep> times and get the distribution for the border values.
+        The random sets are scored in batches (in parallel if a pool is given). Random set i
+        uses the seed [PERM_SEED, hash of the chromosome name, i], the result does therefore
+        not depend on the batch size or the number of processes.
+        flanks: a list of flanks, all scored on the same random sets (default: GLOBAL_LEFT_RIGHT)
+        return: the threshold (a list with one per flank if flanks are given)"""
         diff = sign01vec(floatDiff)
         #diff = negZeroPosVec(floatDiff)
-        temp = numRep*[0]
-        for i in xrange(0, numRep, 1):
-            np.random.shuffle(diff)
-            ranVals = [abs(np.sum(diff[(midPoint-GLOBAL_LEFT_RIGHT):midPoint]) - np.sum(diff[midPoint:(midPoint+GLOBAL_LEFT_RIGHT)])) for midPoint in xrange(GLOBAL_LEFT_RIGHT, diff.size-GLOBAL_LEFT_RIGHT, 1)]
-            temp[i] = np.percentile(np.absolute(ranVals), 99)
-            print >> sys.stderr, "Perm", i, "- 99th percentile:", temp[i]
-        out = sum(temp)/float(len(temp))
-        print >> sys.stderr, "Borderthreshold:", out
+        curFlanks = flanks if flanks is not None else [GLOBAL_LEFT_RIGHT]
+        seed = PERM_SEED if PERM_SEED is not None else np.random.randint(0, 2**31)
+        chromKey = zlib.crc32(self.chrom) & 0xffffffff
+        batchSize = PERM_BATCH if PERM_BATCH else max(1, min(numRep, int(2e7/max(1, diff.size))))
+        tasks = [(diff, curFlanks, [[seed, chromKey, i] for i in xrange(first, min(first+batchSize, numRep))])
+                 for first in xrange(0, numRep, batchSize)]
+        if pool is None:
+            results = itertools.imap(permutationPercentiles, tasks)
+        else:
+            results = pool.imap(permutationPercentiles, tasks)
+        total = np.zeros(len(curFlanks))
+        i = 0
+        for percentiles in results:
+            for j in xrange(percentiles.shape[1]):
+                for k, flank in enumerate(curFlanks):
+                    if len(curFlanks) == 1:
+                        print >> sys.stderr, "Perm", i, "- 99th percentile:", percentiles[k, j]
+                    else:
+                        print >> sys.stderr, "Perm", i, "flank", flank, "- 99th percentile:", percentiles[k, j]
+                    total[k] += percentiles[k, j]
+                i += 1
+        out = [x/i for x in total]
+        print >> sys.stderr, "Borderthreshold:", " ".join([str(x) for x in out])
+        if flanks is None:
+            return out[0]
         return out
 
-    def getRegions(self, minPosFrac=0.7, numRep=10, randomized=False):
+    def getRegions(self, minPosFrac=0.7, numRep=10, randomized=False, pool=None):
         """Compare the control and the test sample.
         minPosFrac: minimal positive fraction
         numRep: number of random sets for the cutoff
+        pool: an optional process pool for the random sets
+        return: a list of significant regions"""
+        return self.getRegionsSweep([minPosFrac], [GLOBAL_LEFT_RIGHT], numRep, randomized, pool)[0]
+
+    def getRegionsSweep(self, minPosFracs, flanks, numRep=10, randomized=False, pool=None):
+        """getRegions for all combinations of flanks and minimal positive fractions. The
+        differences, their signs and cumulative sums and the random sets are computed once.
+        testCov can also hold several test samples (a row per sample), the differences, signs
+        and cumulative sums of all samples are then computed together.
+        return: a list of significant regions per combination (flank by flank, sample by sample)"""
+        realDiffs = np.atleast_2d(self.testCov - self.contCov)
+        css = cumulativeSums(sign01vec(realDiffs))
+        # cumulative numbers of positive and of nonzero differences, the positive fraction
+        # of the nonzero differences in realDiff[a:b] is (pos[b]-pos[a])/(nonzero[b]-nonzero[a])
+        pos = cumulativeSums(realDiffs > 0)
+        nonzero = cumulativeSums(realDiffs != 0)
+        out = []
+        for k, realDiff in enumerate(realDiffs):
+            thresholds = self.getBorderThreshold(realDiff, numRep, pool, flanks)
+            for flank, threshold in zip(flanks, thresholds):
+                borders = self.getBorders(realDiff, threshold, randomized, flank, css[k])
+                for minPosFrac in minPosFracs:
+                    if borders["SKIP"]:
+                        out.append([])
+                    else:
+                        out.append(self.joinBorders(borders, minPosFrac, pos[k], nonzero[k]))
+        return out
+
+    def joinBorders(self, borders, minPosFrac, pos, nonzero):
+        """Join the borders to regions with a positive fraction of at least minPosFrac.
+        pos, nonzero: cumulative numbers of positive and of nonzero differences, the
+        positive fraction is taken over the bins between the two borders
         return: a list of significant regions"""
-        realDiff = self.testCov - self.contCov
-        threshold = self.getBorderThreshold(realDiff, numRep)
-        borders = self.getBorders(realDiff, threshold, randomized)
-        if borders["SKIP"]:
-            return []
-        #diff = negZeroPosVec(realDiff)
         out = []
         prevBorderIdx = borders["BT"].index("LB")
         for i in xrange(prevBorderIdx+1, len(borders["MP"]), 1):
-            temp = realDiff[prevBorderIdx:i]
-            temp = temp[temp!=0]
-            if temp.size > 0:
-                temp = sign01vec(temp)
-                posFrac = temp.mean()
+            a = borders["MP"][prevBorderIdx]
+            b = borders["MP"][i]
+            numNonzero = nonzero[b] - nonzero[a]
+            if numNonzero > 0:
+                posFrac = np.float64(pos[b] - pos[a]) / numNonzero
             else:
                 posFrac = 0
             prevBorderType = borders["BT"][prevBorderIdx]
@@ -235,126 +369,136 @@ class chromosome(object):
         return out
 
 
-class bigWigConnection(object):
-    """A bigWig handler"""
-    def __init__(self, path):
-        self.path = path
-
-    def getChromSizesWigIO(self):
-        wWigIO.open(self.path)
-        out = wWigIO.getChromSize(self.path)
-        out = dict(zip(out[0], out[1]))
-        wWigIO.close(self.path)
-        return out
-
-    def getChromSizesNGSLIB(self):
-        infile = BigWigFile(self.path)
-        out = infile.chromSizes()
-        out = dict(zip(out[0], out[1]))
-        infile.close()
-        return out
-
-    def smoothCoverageSave(self, covArray, winLen=147, winType="flat"):
-        """Calculate smoothened coverage, see http://www.scipy.org/Cookbook/SignalSmooth.
-        Note that winLen should be an odd integer. winType == flat meand moving average."""
-        x = covArray
-        if x.size < winLen:
-            raise ValueError("Input vector needs to be bigger than window size.")
-        if x.ndim != 1:
-            raise ValueError("Smooth only accepts 1 dimension arrays.")
-        if window not in ["flat", "hanning", "hamming", "bartlett", "blackman"]:
-            raise ValueError("Valid winTypes are flat, hanning, hamming, bartlett, and blackman.")
-        s = np.r_[2 * x[0] - x[winLen:1:-1], x, 2 * x[-1] - x[-1:-winLen:-1]]
-        if window == "flat":
-            w = np.ones(winLen, 'd')
-        else:
-            w = eval("np." + window + "(winLen)")
-        y = np.convolve(w / w.sum(), s, mode="same")
-        return y[winLen-1:-winLen+1]
-
-    def smoothCoverageFlat(self, covArray, winLen=147):
-        """Calculate smoothened coverage using moving average.
-        Note that winLen should be an odd integer."""
-        if (winLen % 2) == 0:
-            winLen += 1
-        x = covArray
-        s = np.r_[2 * x[0] - x[winLen:1:-1], x, 2 * x[-1] - x[-1:-winLen:-1]]
-        w = np.ones(winLen, 'd')
-        y = np.convolve(w / w.sum(), s, mode="same")
-        return y[winLen-1:-winLen+1]
-
-    def smoothCoverageSpec(self, covArray, winLen=147, winType="blackman"):
-        """Calculate smoothened coverage with a specified window type.
-        Note that winLen should be an odd integer."""
-        if (winLen % 2) == 0:
-            winLen += 1
-        x = covArray
-        s = np.r_[2 * x[0] - x[winLen:1:-1], x, 2 * x[-1] - x[-1:-winLen:-1]]
-        w = eval("np." + window + "(winLen)")
-        y = np.convolve(w / w.sum(), s, mode="same")
-        return y[winLen-1:-winLen+1]
-
-    def getRawCoverage(self, chrom, start, end):
-        """Retrieve an array with the genome coverage."""
-        out = np.zeros(end-start)
-        infile = BigWigFile(self.path)
-        wigs = infile.fetch(chrom, start, end)
-        for wig in wigs:
-            out[wig[0]-start:wig[1]-start] = wig[2]
-        infile.close()
-        return out
-
-    def getSmoothCoverage(self, chrom, start, end, winLen=147, winType="flat"):
-        """Retrieve an array with the smoothened genome coverage.
-        CHECK/TODO: one might have to extend the coverage array first"""
-        raw = self.getRawCoverage(chrom, start, end)
-        if winType == "flat":
-            out = self.smoothCoverageFlat(raw, winLen)
-        else:
-            out = self.smoothCoverageSpec(raw, winLen, winType)
-        return out
-
-    def getRawCoverageLargeMode(self, chrom, start, end, largeMode=1e3):
-        """Retrieve an array with the genome coverage."""
-        out = np.zeros(end-start)
-        infile = BigWigFile(self.path)
-        wigs = infile.fetch(chrom, start, end)
-        for wig in wigs:
-            out[wig[0]-start:wig[1]-start] = wig[2]
-        infile.close()
-        return out[::largeMode]
-
-    def getSmoothCoverageLargeMode(self, chrom, start, end, winLen=1e5, winType="flat", largeMode=1e3):
-        """Retrieve an array with the smoothened genome coverage.
-        CHECK/TODO: one might have to extend the coverage array first"""
-        winLen = int(winLen/largeMode)
-        raw = self.getRawCoverageLargeMode(chrom, start, end, largeMode)
-        if winType == "flat":
-            out = self.smoothCoverageFlat(raw, winLen)
-        else:
-            out = self.smoothCoverageSpec(raw, winLen, winType)
-        return out
+workerState = {}
+
+
+def initWorker(contPath, testPaths, permProcesses=1, reseed=False):
+    """Pool initializer: every worker process gets its own bigWigConnections
+    (and a pool for the random sets if permProcesses > 1)."""
+    workerState["cont"] = bigWigConnection(contPath, cacheDir=cacheDir, cacheSize=cacheSize)
+    workerState["tests"] = [bigWigConnection(testPath, cacheDir=cacheDir, cacheSize=cacheSize)
+                            for testPath in testPaths]
+    workerState["permPool"] = multiprocessing.Pool(permProcesses) if permProcesses > 1 else None
+    if reseed:
+        # forked workers would otherwise share the random state
+        np.random.seed()
+
+
+def readChromosome(args):
+    """Read the coverage of a chromosome with the bigWigConnections of the worker.
+    return: the chromosome, its size and the control and test coverage (None if no
+    flank fits the chromosome)"""
+    chrom, size = args
+    print >> sys.stderr, "reading chromosome %s of length %d" % (chrom, size)
+    if size < 10*min([int(curFlank/baseSteps) for curFlank in flankSizes])*baseSteps:
+        return chrom, size, None, None
+    # the binned coverage is read tile by tile, so the intervals of a whole chromosome
+    # are never held in memory at once; the control is read once for all test samples
+    contCov = workerState["cont"].getTiledCoverage(chrom, size, tileSize, 0, "flat", baseSteps, binMode)
+    testCovs = [testBW.getTiledCoverage(chrom, size, tileSize, 0, "flat", baseSteps, binMode)
+                for testBW in workerState["tests"]]
+    testCov = testCovs[0] if len(testCovs) == 1 else np.vstack(testCovs)
+    return chrom, size, contCov, testCov
+
+
+def testChromosome(args):
+    """Get the regions of a chromosome from its coverage (see readChromosome).
+    return: the chromosome and the lines of its significant regions (a list per test sample
+    and setting)"""
+    chrom, size, contCov, testCov = args
+    print >> sys.stderr, "processing chromosome %s of length %d" % (chrom, size)
+    numTests = len(workerState["tests"])
+    # the flanks (in bins) that fit this chromosome, the others give no regions
+    flanks = [int(curFlank/baseSteps) for curFlank in flankSizes if size >= 10*int(curFlank/baseSteps)*baseSteps]
+    if not flanks:
+        return chrom, [[] for k in xrange(numTests) for curFlank in flankSizes for curFrac in fPositives]
+    curChrom = chromosome(chrom, 0, size, baseSteps, contCov, testCov)
+    results = iter(curChrom.getRegionsSweep(fPositives, flanks, numReps, randomized, workerState["permPool"]))
+    out = []
+    for k in xrange(numTests):
+        for curFlank in flankSizes:
+            for curFrac in fPositives:
+                if size >= 10*int(curFlank/baseSteps)*baseSteps:
+                    out.append([str(reg) for reg in results.next()])
+                else:
+                    out.append([])
+    return chrom, out
+
+
+def scanChromosomeTask(args):
+    """Pool worker: read and test a chromosome with the bigWigConnections of the worker."""
+    return testChromosome(readChromosome(args))
+
+
+def sweepFileNames(prefix):
+    """The output names of all settings of a sweep, in the order of scanChromosomeTask.
+    The values are written as given on the command line."""
+    flankNames = sys.argv[sys.argv.index("--flankSize")+1].split(",") if "--flankSize" in sys.argv else ["100000"]
+    fracNames = sys.argv[sys.argv.index("--fPositive")+1].split(",") if "--fPositive" in sys.argv else ["0.7"]
+    return ["%s.ET.%s_%d_%s_%d.txt" % (prefix, curFlank, baseSteps, curFrac, numReps)
+            for curFlank in flankNames for curFrac in fracNames]
 
 
 if (__name__ == "__main__"):
     contBW = bigWigConnection(bwControl)
-    testBW = bigWigConnection(bwTest)
     contCS = contBW.getChromSizesNGSLIB()
-    testCS = testBW.getChromSizesNGSLIB()
-    if len(contCS) != len(testCS):
-        print >> sys.stderr, "WARNING: The two files have different numbers of chromosomes."
-    chromsToCheck = intersect(contCS.keys(), testCS.keys())
-    for chrom in chromsToCheck:
+    contBW.close()
+    chroms = contCS.keys()
+    testCSs = []
+    for curTest in bwTests:
+        testBW = bigWigConnection(curTest)
+        testCS = testBW.getChromSizesNGSLIB()
+        testBW.close()
+        if len(contCS) != len(testCS):
+            print >> sys.stderr, "WARNING: The two files have different numbers of chromosomes."
+        chroms = intersect(chroms, testCS.keys())
+        testCSs.append(testCS)
+    chromSizes = {}
+    for chrom in sorted(chroms):
         contSize = contCS[chrom]
-        testSize = testCS[chrom]
+        testSize = max([testCS[chrom] for testCS in testCSs])
         size = max([contSize, testSize])
-        if size < 10*GLOBAL_LEFT_RIGHT*baseSteps:
+        if size < 10*min([int(curFlank/baseSteps) for curFlank in flankSizes])*baseSteps:
             print >> sys.stderr, "skipping chromosome %s due to its size" % chrom
             continue
-        print >> sys.stderr, "processing chromosome %s of length %d" % (chrom, size)
-        curChrom = chromosome(chrom, 0, size, baseSteps)
-        curChrom.addRawContCovLargeMode(contBW)
-        curChrom.addRawTestCovLargeMode(testBW)
-        sigRegs = curChrom.getRegions(fPositive, numReps, randomized)
-        for reg in sigRegs:
-            print reg
+        chromSizes[chrom] = size
+    chromsToCheck = sorted(chromSizes.keys())
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initWorker, (bwControl, bwTests, 1, True))
+        tasks = sorted(chromSizes.items(), key=lambda x: x[1], reverse=True)
+        results = pool.imap_unordered(scanChromosomeTask, tasks)
+    else:
+        pool = None
+        initWorker(bwControl, bwTests, permProcesses)
+        # the next chromosomes are read while the current one is tested
+        coverages = prefetch(itertools.imap(readChromosome, [(chrom, chromSizes[chrom]) for chrom in chromsToCheck]),
+                             prefetchDepth)
+        results = itertools.imap(testChromosome, coverages)
+    if batchPrefix is not None:
+        # a file per test sample and setting, in the order of scanChromosomeTask
+        names = []
+        for curTest in bwTests:
+            curNames = sweepFileNames("%s_%s" % (batchPrefix, sampleName(curTest)))
+            names.extend(curNames if sweepPrefix is not None else curNames[:1])
+        outFiles = [open(name, "w") for name in names]
+    elif sweepPrefix is None:
+        outFiles = [sys.stdout]
+    else:
+        outFiles = [open(name, "w") for name in sweepFileNames(sweepPrefix)]
+    for chrom, settings in inChromOrder(results, chromsToCheck):
+        for outFile, lines in zip(outFiles, settings):
+            for line in lines:
+                print >> outFile, line
+    for outFile in outFiles:
+        if outFile is not sys.stdout:
+            outFile.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    else:
+        workerState["cont"].close()
+        for testBW in workerState["tests"]:
+            testBW.close()
+        if workerState["permPool"] is not None:
+            workerState["permPool"].close()
+            workerState["permPool"].join()
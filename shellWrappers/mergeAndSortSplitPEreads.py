@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """
 usage:
-python mergeAndSortSplitPEreads.py R1 R2 outR1 outR2 outUnpairable [--solid] [--maxReads <int>]
+python mergeAndSortSplitPEreads.py R1 R2 outR1 outR2 outUnpairable [--solid] [--maxReads <int>] [--hashJoin] [--buckets <int>] [--processes <int>] [--tmpDir <dir>] [--threads <int>]
 
 arguments:
 R1 and R1: .fastq(.gz) files with forward/reverse reads (can be compressed, .gz only)
@@ -9,6 +9,18 @@ outR1 and outR2: .fastq(.gz) files with the merged and sorted forward/reverse re
 outUnpairable: .fastq(.gz) file with the unpairable reads
 --solid: if given, names are assumed to be @X_Y_Z_F3 and @X_Y_Z_F3-RNA/BC
 --maxReads <int>: number of reads stored in memory (default is 1 million)
+                  reads are kept as raw records in one buffer, a block of 20 million reads
+                  needs roughly as much memory as the reads take uncompressed on disk
+--hashJoin: if given, both files are split into buckets (by a hash of the read name) on disk and
+            each bucket is paired in memory. Each input file is read only once, memory is bounded
+            by the size of a bucket (--maxReads has no effect).
+--buckets <int>: number of buckets for --hashJoin (default is 64)
+--threads <int>: number of threads, with more than one thread the compressed input and output
+                 files are (de)compressed by pigz (or gzip) subprocesses (default is 1)
+--processes <int>: pair the buckets of --hashJoin in parallel with this many processes (implies
+                   --hashJoin), the pairs of each bucket are written to separate files which are
+                   concatenated at the end
+--tmpDir <dir>: directory for the buckets (default is the system temp directory)
 
 requirements:
 - four lines per read
@@ -17,8 +29,19 @@ requirements:
 - space character will be used to separate the read name and the mate info
 """
 
+import array
 import gzip
+import itertools
+import multiprocessing
+import os
+import re
+import signal
+import subprocess
+import shutil
 import sys
+import tempfile
+from distutils.spawn import find_executable
+import zlib
 
 # check input
 try:
@@ -45,96 +68,377 @@ class basicRead(object):
         return '\n'.join([self.seqHead, self.seq, self.qualHead, self.qual])
 
     def getName(self):
-        return self.seqHead
+        return self.nameFromHead(self.seqHead)
+
+    @staticmethod
+    def nameFromHead(seqHead):
+        return seqHead
+
+    @staticmethod
+    def namesFromRecords(records):
+        """the names of a list of records (see fastqChunkIter)"""
+        return [record.partition('\n')[0] for record in records]
 
 
 class illuminaRead(basicRead):
     """An illumina read with the headers and sequences"""
-    def getName(self):
-        return self.seqHead.split(' ')[0]
+    @staticmethod
+    def nameFromHead(seqHead):
+        return seqHead.split(' ')[0]
+
+    @staticmethod
+    def namesFromRecords(records):
+        """the names of a list of records (see fastqChunkIter)"""
+        return [record.partition('\n')[0].partition(' ')[0] for record in records]
 
 
 class solidRead(basicRead):
     """A solid read with the headers and sequences"""
-    def getName(self):
-        return '_'.join(self.seqHead.split('_')[:-1])
+    @staticmethod
+    def nameFromHead(seqHead):
+        return '_'.join(seqHead.split('_')[:-1])
+
+    @staticmethod
+    def namesFromRecords(records):
+        """the names of a list of records (see fastqChunkIter)"""
+        return [record.partition('\n')[0].rpartition('_')[0] for record in records]
+
+
+class pipedFile(object):
+    """A compressed file which is (de)compressed by a pigz (or gzip) subprocess"""
+    def __init__(self, fileName, mode="r", threads=1, compresslevel=9):
+        self.rawFile = None
+        self.fileName = fileName
+        executable = find_executable("pigz") or find_executable("gzip")
+        if "r" in mode:
+            command = [executable, "-dc", fileName]
+            self.proc = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=-1,
+                                         preexec_fn=restoreSigpipe)
+            self.fileobj = self.proc.stdout
+        else:
+            command = [executable, "-%d" % compresslevel, "-c"]
+            if executable.endswith("pigz"):
+                command[1:1] = ["-p", str(threads)]
+            self.rawFile = open(fileName, "wb")
+            self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.rawFile,
+                                         bufsize=-1, preexec_fn=restoreSigpipe)
+            self.fileobj = self.proc.stdin
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.fileobj)
+
+    def readline(self):
+        return self.fileobj.readline()
+
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+
+    def write(self, data):
+        self.fileobj.write(data)
+
+    def close(self):
+        self.fileobj.close()
+        rc = self.proc.wait()
+        if self.rawFile is not None:
+            self.rawFile.close()
+        if rc not in (0, -signal.SIGPIPE):
+            raise IOError("(de)compression of %s failed with exit code %d" % (self.fileName, rc))
+
 
+def restoreSigpipe():
+    """python ignores SIGPIPE, the (de)compression subprocesses should not"""
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-def myopen(fileName, mode="r"):
-    """open either a regular or a compressed file"""
+
+def myopen(fileName, mode="r", compresslevel=9, threads=1):
+    """open either a regular or a compressed file
+    with threads > 1, compressed files are handled by a pigz (or gzip) subprocess"""
     if fileName.endswith(".gz"):
-        return gzip.open(fileName, mode=mode)
+        if threads > 1 and (find_executable("pigz") or find_executable("gzip")):
+            return pipedFile(fileName, mode, threads, compresslevel)
+        return gzip.open(fileName, mode=mode, compresslevel=compresslevel)
     else:
         return open(fileName, mode=mode)
 
 
-def fastqIter(infileName, readObject):
-    """file iterator (returns readObjects - e.g. solidRead or illuminaRead)"""
-    with myopen(infileName) as infile:
+fastqRecord = re.compile(r'([^\n]*\n[^\n]*\n[^\n]*\n[^\n]*)\n')
+
+
+def fastqChunkIter(infileName, readObject, threads=1, chunkSize=8388608):
+    """bulk file iterator, reads chunks of <chunkSize> bytes and returns lists of (name, record)
+    tuples - the records are the four lines of a read (without the final newline) and are split
+    off a chunk by one regular expression, the names are parsed with the readObject (e.g. solidRead
+    or illuminaRead). Empty lines are only allowed at the end of the file, an empty line followed
+    by more reads raises a ValueError."""
+    getNames = readObject.namesFromRecords
+    rest = ''
+    offset = 0
+    with myopen(infileName, threads=threads) as infile:
         while True:
-            seqHead = infile.readline().strip()
-            if not seqHead:
+            chunk = infile.read(chunkSize)
+            if not chunk:
+                chunk = '\n' if rest.strip() else ''
+            if not chunk:
                 break
-            seq = infile.readline().strip()
-            qualHead = infile.readline().strip()
-            qual = infile.readline().strip()
-            yield readObject(seqHead, seq, qualHead, qual)
+            if '\r' in chunk:
+                chunk = chunk.replace('\r', '')
+            text = rest + chunk
+            records = fastqRecord.findall(text)
+            used = sum(map(len, records)) + len(records)
+            if text.startswith('\n') or '\n\n' in text:
+                # there may be empty lines instead of read headers
+                blank = [i for i, record in enumerate(records) if not record.partition('\n')[0].strip()]
+                if blank:
+                    used = sum([len(record) + 1 for record in records[:blank[0]]])
+                    if text[used:].strip():
+                        raise ValueError("%s: empty line instead of a read header near byte %d"
+                                         % (infileName, offset + used))
+                    # empty lines so far, they are fine if the file ends here
+                    records = records[:blank[0]]
+            rest = text[used:]
+            offset += used
+            yield zip(getNames(records), records)
+
+
+def fastqIter(infileName, readObject, threads=1, chunkSize=8388608):
+    """file iterator (returns (name, record) tuples, see fastqChunkIter)"""
+    return itertools.chain.from_iterable(fastqChunkIter(infileName, readObject, threads, chunkSize))
+
+class readBlock(object):
+    """A block of reads stored as raw records in one contiguous buffer.
+    The records are indexed by the read name and written out without copying."""
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array.array('L', [0])
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def add(self, name, record):
+        """add a record (the four lines, without the final newline)"""
+        self.data.extend(record)
+        self.data.extend('\n')
+        self.offsets.append(len(self.data))
+        self.index[name] = len(self.offsets) - 2
+
+    def getRecord(self, i):
+        """a zero-copy view on the i-th record"""
+        return buffer(self.data, self.offsets[i], self.offsets[i+1] - self.offsets[i])
+
+    def getSeq(self, name):
+        """the sequence of a read (copies the record)"""
+        return str(self.getRecord(self.index[name])).split('\n')[1]
+
+    def pop(self, name):
+        """remove a read from the index and return a view on its record"""
+        return self.getRecord(self.index.pop(name))
+
+    def remaining(self):
+        """views on all records which were not popped (in the order they were added)"""
+        for i in sorted(self.index.itervalues()):
+            yield self.getRecord(i)
+
 
 def readFileBlock(fastqIterator, numberOfReads):
-    """read <numberOfReads> reads into a dictionary with the names (no mate info) as key"""
+    """read <numberOfReads> reads into a readBlock with the names (no mate info) as key"""
     notUnique = 0
-    out = {}
-    for i in xrange(0, numberOfReads, 1):
-        try:
-            read = fastqIterator.next()
-        except:
-            break
-        if read.name in out:
-            if read.seq != out[read.name].seq:
+    out = readBlock()
+    for name, record in itertools.islice(fastqIterator, numberOfReads):
+        if name in out:
+            if record.split('\n')[1] != out.getSeq(name):
                 notUnique += 1
-                print >> sys.stderr, "And sequence is NOT THE SAME:\n", read
-        out[read.name] = read
+                print >> sys.stderr, "And sequence is NOT THE SAME:\n", record
+        out.add(name, record)
     return(out)
 
+
+class ordinalBitmap(object):
+    """A growing bitmap with one bit per read (indexed by the position of the read in the file)"""
+    def __init__(self):
+        self.bits = bytearray()
+
+    def set(self, i):
+        byte = i >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytearray(max(byte + 1 - len(self.bits), len(self.bits))))
+        self.bits[byte] |= 1 << (i & 7)
+
+    def get(self, i):
+        byte = i >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (i & 7)))
+
+
+def blockJoin(infileNameR1, infileNameR2, outR1, outR2, outUP, readObject, maxReads=1000000,
+              threads=1):
+    """re-pair the reads by loading blocks of <maxReads> R1 reads and scanning R2 once per block.
+    The paired R2 reads are marked in a bitmap and the unpairable R2 reads are written during the
+    scan for the last block."""
+    matched = 0
+    counter = 0
+    paired = ordinalBitmap()
+    iterR1 = fastqIter(infileNameR1, readObject, threads)
+    lastBlock = False
+    while not lastBlock:
+        R1 = readFileBlock(iterR1, maxReads)
+        counter += len(R1)
+        print >> sys.stderr, "loaded %d R1 reads..." % counter
+        nextRead = next(iterR1, None)
+        lastBlock = nextRead is None
+        if not lastBlock:
+            iterR1 = itertools.chain([nextRead], iterR1)
+        for i, (name, record) in enumerate(fastqIter(infileNameR2, readObject, threads)):
+            if name in R1:
+                matched += 1
+                outR1.write(R1.pop(name))
+                print >> outR2, record
+                paired.set(i)
+            elif lastBlock and not paired.get(i):
+                print >> outUP, record
+        for record in R1.remaining():
+            outUP.write(record)
+    return matched
+
+
+def hashBucket(name, numBuckets):
+    """assign a read name to one of <numBuckets> buckets (stable across runs)"""
+    return (zlib.crc32(name) & 0xffffffff) % numBuckets
+
+
+def partitionFastq(fastqIterator, bucketFileNames):
+    """distribute the reads into the bucket files according to a hash of their name"""
+    numBuckets = len(bucketFileNames)
+    bucketFiles = [myopen(fn, 'w', compresslevel=1) for fn in bucketFileNames]
+    counter = 0
+    try:
+        for name, record in fastqIterator:
+            print >> bucketFiles[hashBucket(name, numBuckets)], record
+            counter += 1
+    finally:
+        for bucketFile in bucketFiles:
+            bucketFile.close()
+    return counter
+
+
+def joinBucket(bucketNameR1, bucketNameR2, readObject, outR1, outR2, outUP):
+    """pair the reads of one bucket in memory, returns the number of matched pairs"""
+    matched = 0
+    R1 = readFileBlock(fastqIter(bucketNameR1, readObject), sys.maxint)
+    for name, record in fastqIter(bucketNameR2, readObject):
+        if name in R1:
+            matched += 1
+            outR1.write(R1.pop(name))
+            print >> outR2, record
+        else:
+            print >> outUP, record
+    for record in R1.remaining():
+        outUP.write(record)
+    return matched
+
+
+def hashJoin(infileNameR1, infileNameR2, outR1, outR2, outUP, readObject, numBuckets=64, tmpDir=None,
+             threads=1):
+    """re-pair the reads by splitting both files into buckets and joining bucket by bucket"""
+    bucketDir = tempfile.mkdtemp(prefix="repairBuckets_", dir=tmpDir)
+    bucketsR1 = [os.path.join(bucketDir, "R1_%d.fq.gz" % i) for i in xrange(numBuckets)]
+    bucketsR2 = [os.path.join(bucketDir, "R2_%d.fq.gz" % i) for i in xrange(numBuckets)]
+    matched = 0
+    try:
+        counter = partitionFastq(fastqIter(infileNameR1, readObject, threads), bucketsR1)
+        print >> sys.stderr, "partitioned %d R1 reads into %d buckets..." % (counter, numBuckets)
+        counter = partitionFastq(fastqIter(infileNameR2, readObject, threads), bucketsR2)
+        print >> sys.stderr, "partitioned %d R2 reads into %d buckets..." % (counter, numBuckets)
+        for i in xrange(numBuckets):
+            matched += joinBucket(bucketsR1[i], bucketsR2[i], readObject, outR1, outR2, outUP)
+            os.remove(bucketsR1[i])
+            os.remove(bucketsR2[i])
+    finally:
+        shutil.rmtree(bucketDir)
+    return matched
+
+
+def partitionFile(args):
+    """pool worker: distribute the reads of one file into the bucket files"""
+    infileName, readObject, bucketFileNames, threads = args
+    return partitionFastq(fastqIter(infileName, readObject, threads), bucketFileNames)
+
+
+def joinBucketToFiles(args):
+    """pool worker: pair the reads of one bucket and write them to separate files"""
+    bucketNameR1, bucketNameR2, readObject, partNames = args
+    with myopen(partNames[0], 'w') as outR1, myopen(partNames[1], 'w') as outR2, \
+         myopen(partNames[2], 'w') as outUP:
+        matched = joinBucket(bucketNameR1, bucketNameR2, readObject, outR1, outR2, outUP)
+    os.remove(bucketNameR1)
+    os.remove(bucketNameR2)
+    return matched
+
+
+def concatenateFiles(infileNames, outfileName):
+    """concatenate files byte by byte (gzip files can be concatenated as they are)"""
+    with open(outfileName, 'wb') as outfile:
+        for infileName in infileNames:
+            with open(infileName, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile, 16777216)
+            os.remove(infileName)
+
+
+def shardedJoin(infileNameR1, infileNameR2, outfileNames, readObject, numBuckets=64, processes=2,
+                tmpDir=None, threads=1):
+    """re-pair the reads like hashJoin, but partition R1 and R2 and pair the buckets in a process
+    pool. outfileNames are the names of the R1, the R2 and the unpairable output file."""
+    bucketDir = tempfile.mkdtemp(prefix="repairBuckets_", dir=tmpDir)
+    bucketsR1 = [os.path.join(bucketDir, "R1_%d.fq.gz" % i) for i in xrange(numBuckets)]
+    bucketsR2 = [os.path.join(bucketDir, "R2_%d.fq.gz" % i) for i in xrange(numBuckets)]
+    partNames = [[os.path.join(bucketDir, "part%d_%s" % (i, os.path.basename(fn)))
+                  for fn in outfileNames] for i in xrange(numBuckets)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        counts = pool.map(partitionFile, [(infileNameR1, readObject, bucketsR1, threads),
+                                          (infileNameR2, readObject, bucketsR2, threads)])
+        print >> sys.stderr, "partitioned %d R1 and %d R2 reads into %d buckets..." % (counts[0], counts[1], numBuckets)
+        tasks = [(bucketsR1[i], bucketsR2[i], readObject, partNames[i]) for i in xrange(numBuckets)]
+        matched = sum(pool.imap_unordered(joinBucketToFiles, tasks))
+        pool.close()
+        pool.join()
+        for j, outfileName in enumerate(outfileNames):
+            concatenateFiles([parts[j] for parts in partNames], outfileName)
+    finally:
+        pool.terminate()
+        shutil.rmtree(bucketDir)
+    return matched
+
+
 if __name__ == "__main__":
     maxReads = int(sys.argv[sys.argv.index("--maxReads")+1]) if "--maxReads" in sys.argv else int(1000000)
+    numBuckets = int(sys.argv[sys.argv.index("--buckets")+1]) if "--buckets" in sys.argv else int(64)
+    tmpDir = sys.argv[sys.argv.index("--tmpDir")+1] if "--tmpDir" in sys.argv else None
+    threads = int(sys.argv[sys.argv.index("--threads")+1]) if "--threads" in sys.argv else int(1)
+    processes = int(sys.argv[sys.argv.index("--processes")+1]) if "--processes" in sys.argv else int(1)
     readObject = solidRead if "--solid" in sys.argv else illuminaRead
     matched = 0
-    counter = 0
-    paired = set([])
-    with myopen(outfileNameR1, 'w') as outR1, myopen(outfileNameR2, 'w') as outR2, myopen(outfileNameUP, 'w') as outUP:
-        iterR1 = fastqIter(infileNameR1, readObject)
-        while True:
-            R1 = readFileBlock(iterR1, maxReads)
-            counter += len(R1)
-            print >> sys.stderr, "loaded %d R1 reads..." % counter
-            if not R1:
-                break
-            iterR2 = fastqIter(infileNameR2, readObject)
-            while True:
-                try:
-                    read = iterR2.next()
-                except:
-                    break
-                if read.name in R1:
-                    matched += 1
-                    print >> outR1, R1.pop(read.name)
-                    print >> outR2, read
-                    paired.add(read.name)
-                #else:
-                    #print >> outUP, read # only works if all in memory
-            for rn, read in R1.items():
-                print >> outUP, read
-        # write out the unpairable reverse reads
-        iterR2 = fastqIter(infileNameR2, readObject)
-        while True:
-            try:
-                read = iterR2.next()
-            except:
-                break
-            if read.name not in paired:
-                print >> outUP, read
-        
+    if processes > 1:
+        matched = shardedJoin(infileNameR1, infileNameR2, [outfileNameR1, outfileNameR2, outfileNameUP],
+                              readObject, numBuckets, processes, tmpDir, threads)
+    else:
+        with myopen(outfileNameR1, 'w', threads=threads) as outR1, \
+             myopen(outfileNameR2, 'w', threads=threads) as outR2, \
+             myopen(outfileNameUP, 'w', threads=threads) as outUP:
+            if "--hashJoin" in sys.argv:
+                matched = hashJoin(infileNameR1, infileNameR2, outR1, outR2, outUP, readObject,
+                                   numBuckets, tmpDir, threads)
+            else:
+                matched = blockJoin(infileNameR1, infileNameR2, outR1, outR2, outUP, readObject,
+                                    maxReads, threads)
     print >> sys.stderr, "matched %d pairs" % matched
 
 
@@ -28,6 +28,7 @@ prefix=""
 inputFile=""
 inputFileReverse=""
 solidOption=""
+hashJoin=""
 pyScript="$HOME/mergeAndSortSplitPEreads.py"
 threads=1
 compThreadsMerge=1
@@ -84,10 +85,12 @@ The reads in these files will be added to the *.unpairable.fq.gz.
 Options:
   -v            Enable verbose logging (no effect)
   -h            Print this help text
-  -t		Number of available threads (no effect)
+  -t		Number of available threads (used by pigz for the input and output files)
   -m            Amount of memory to be allocated (per core, in GB, no effect)
   -s		Path to the python script (default: ${pyScript})
   -c		Specifies that the read come from a SOLID machine
+  -j		Use the hash-join mode (reads each input only once, needs temporary disk space in OUTDIR,
+		with more than one thread, the buckets are paired in parallel)
 __EOF__
 }
 
@@ -138,8 +141,8 @@ remove_if_present () {
 
 ## parse command-line
 
-short_opts='hvt:m:s:c'
-long_opts='help,verbose,threads,memory,pyScript,solid'
+short_opts='hvt:m:s:cj'
+long_opts='help,verbose,threads,memory,pyScript,solid,hashJoin'
 
 getopt -T > /dev/null
 rc=$?
@@ -163,6 +166,7 @@ fi
 while [ $# -gt 0 ]; do
     case "$1" in
 	--solid|-c)    solidOption=" --solid" ;;
+	--hashJoin|-j) hashJoin="yes" ;;
         --pyScript|-s) shift; pyScript=$1 ;;
 	--threads|-t)  shift; threads=$1 ;;
 	--memory|-m)   shift; memory=$1 ;;	
@@ -198,6 +202,14 @@ shift
 inputFilesUnpaired=("$@")
 numUnpairedInputFiles=${#inputFilesUnpaired[@]}
 
+joinOption=""
+if [ -n "$hashJoin" ]; then
+joinOption=" --hashJoin --tmpDir ${outputDir}"
+if [ $threads -gt 1 ]; then
+joinOption="${joinOption} --processes ${threads}"
+fi
+fi
+
 ## main
 echo "=== ${me}: Starting at `date '+%Y-%m-%d %H:%M:%S'`"
 
@@ -217,7 +229,7 @@ fi
 # merge the reads
 command="python ${pyScript} ${inputDir}/${inputFile} ${inputDir}/${inputFileReverse}\
 	 ${outputDir}/${prefix}_R1.repaired.fq.gz ${outputDir}/${prefix}_R2.repaired.fq.gz\
-	 ${outputDir}/${prefix}_TEMP.unpairable.fq.gz --maxReads 3000000${solidOption}"
+	 ${outputDir}/${prefix}_TEMP.unpairable.fq.gz --maxReads 3000000 --threads ${threads}${solidOption}${joinOption}"
 echo "=== ${me}: Running: ${command}"
 eval $command
 rc=$?
@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 """
 usage:
-python mergeAndSortSplitPEreads.py R1 R2 outR1 outR2 outUnpairable [--solid]
+python mergeSortedSplitPEreads.py R1 R2 outR1 outR2 outUnpairable [--solid] [--sort] [--maxReads <int>] [--tmpDir <dir>] [--threads <int>]
 
 arguments:
 R1 and R1: .fastq(.gz) files with forward/reverse reads (can be compressed, .gz only)
-    IMPORTANT: the files must be sorted according to the read name.
+    IMPORTANT: the files must be sorted according to the read name (unless --sort is given).
 outR1 and outR2: .fastq(.gz) files with the merged and sorted forward/reverse reads
 outUnpairable: .fastq(.gz) file with the unpairable reads
 
 --solid: if given, names are assumed to be @X_Y_Z_F3 and @X_Y_Z_F3-RNA/BC
+--sort: if given, the input files are sorted by read name first (external merge sort,
+        sorted runs of --maxReads reads are stored in compressed temporary files)
+--maxReads <int>: number of reads sorted in memory (default is 1 million)
+--threads <int>: number of threads, with more than one thread the compressed input and output
+                 files are (de)compressed by pigz (or gzip) subprocesses (default is 1)
+--tmpDir <dir>: directory for the sorted runs (default is the system temp directory)
 
 requirements:
 - four lines per read
@@ -19,7 +25,15 @@ requirements:
 """
 
 import gzip
+import heapq
+import itertools
+import os
+import re
+import signal
+import subprocess
 import sys
+import tempfile
+from distutils.spawn import find_executable
 
 # check input
 try:
@@ -46,68 +60,220 @@ class basicRead(object):
         return '\n'.join([self.seqHead, self.seq, self.qualHead, self.qual])
 
     def getName(self):
-        return self.seqHead
+        return self.nameFromHead(self.seqHead)
+
+    @staticmethod
+    def nameFromHead(seqHead):
+        return seqHead
+
+    @staticmethod
+    def namesFromRecords(records):
+        """the names of a list of records (see fastqChunkIter)"""
+        return [record.partition('\n')[0] for record in records]
 
 
 class illuminaRead(basicRead):
     """An illumina read with the headers and sequences"""
-    def getName(self):
-        return self.seqHead.split(' ')[0]
+    @staticmethod
+    def nameFromHead(seqHead):
+        return seqHead.split(' ')[0]
+
+    @staticmethod
+    def namesFromRecords(records):
+        """the names of a list of records (see fastqChunkIter)"""
+        return [record.partition('\n')[0].partition(' ')[0] for record in records]
 
 
 class solidRead(basicRead):
     """A solid read with the headers and sequences"""
-    def getName(self):
-        return '_'.join(self.seqHead.split('_')[:-1])
+    @staticmethod
+    def nameFromHead(seqHead):
+        return '_'.join(seqHead.split('_')[:-1])
+
+    @staticmethod
+    def namesFromRecords(records):
+        """the names of a list of records (see fastqChunkIter)"""
+        return [record.partition('\n')[0].rpartition('_')[0] for record in records]
+
+
+class pipedFile(object):
+    """A compressed file which is (de)compressed by a pigz (or gzip) subprocess"""
+    def __init__(self, fileName, mode="r", threads=1, compresslevel=9):
+        self.rawFile = None
+        self.fileName = fileName
+        executable = find_executable("pigz") or find_executable("gzip")
+        if "r" in mode:
+            command = [executable, "-dc", fileName]
+            self.proc = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=-1,
+                                         preexec_fn=restoreSigpipe)
+            self.fileobj = self.proc.stdout
+        else:
+            command = [executable, "-%d" % compresslevel, "-c"]
+            if executable.endswith("pigz"):
+                command[1:1] = ["-p", str(threads)]
+            self.rawFile = open(fileName, "wb")
+            self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.rawFile,
+                                         bufsize=-1, preexec_fn=restoreSigpipe)
+            self.fileobj = self.proc.stdin
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.fileobj)
+
+    def readline(self):
+        return self.fileobj.readline()
+
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+
+    def write(self, data):
+        self.fileobj.write(data)
+
+    def close(self):
+        self.fileobj.close()
+        rc = self.proc.wait()
+        if self.rawFile is not None:
+            self.rawFile.close()
+        if rc not in (0, -signal.SIGPIPE):
+            raise IOError("(de)compression of %s failed with exit code %d" % (self.fileName, rc))
 
 
-def myopen(fileName, mode="r"):
-    """open either a regular or a compressed file"""
+def restoreSigpipe():
+    """python ignores SIGPIPE, the (de)compression subprocesses should not"""
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def myopen(fileName, mode="r", compresslevel=9, threads=1):
+    """open either a regular or a compressed file
+    with threads > 1, compressed files are handled by a pigz (or gzip) subprocess"""
     if fileName.endswith(".gz"):
-        return gzip.open(fileName, mode=mode)
+        if threads > 1 and (find_executable("pigz") or find_executable("gzip")):
+            return pipedFile(fileName, mode, threads, compresslevel)
+        return gzip.open(fileName, mode=mode, compresslevel=compresslevel)
     else:
         return open(fileName, mode=mode)
 
 
-def fastqIter(infileName, readObject):
-    """file iterator (returns readObjects - e.g. solidRead or illuminaRead)"""
-    with myopen(infileName) as infile:
+fastqRecord = re.compile(r'([^\n]*\n[^\n]*\n[^\n]*\n[^\n]*)\n')
+
+
+def fastqChunkIter(infileName, readObject, threads=1, chunkSize=8388608):
+    """bulk file iterator, reads chunks of <chunkSize> bytes and returns lists of (name, record)
+    tuples - the records are the four lines of a read (without the final newline) and are split
+    off a chunk by one regular expression, the names are parsed with the readObject (e.g. solidRead
+    or illuminaRead). Empty lines are only allowed at the end of the file, an empty line followed
+    by more reads raises a ValueError."""
+    getNames = readObject.namesFromRecords
+    rest = ''
+    offset = 0
+    with myopen(infileName, threads=threads) as infile:
         while True:
-            seqHead = infile.readline().strip()
-            if not seqHead:
+            chunk = infile.read(chunkSize)
+            if not chunk:
+                chunk = '\n' if rest.strip() else ''
+            if not chunk:
                 break
-            seq = infile.readline().strip()
-            qualHead = infile.readline().strip()
-            qual = infile.readline().strip()
-            yield readObject(seqHead, seq, qualHead, qual)
+            if '\r' in chunk:
+                chunk = chunk.replace('\r', '')
+            text = rest + chunk
+            records = fastqRecord.findall(text)
+            used = sum(map(len, records)) + len(records)
+            if text.startswith('\n') or '\n\n' in text:
+                # there may be empty lines instead of read headers
+                blank = [i for i, record in enumerate(records) if not record.partition('\n')[0].strip()]
+                if blank:
+                    used = sum([len(record) + 1 for record in records[:blank[0]]])
+                    if text[used:].strip():
+                        raise ValueError("%s: empty line instead of a read header near byte %d"
+                                         % (infileName, offset + used))
+                    # empty lines so far, they are fine if the file ends here
+                    records = records[:blank[0]]
+            rest = text[used:]
+            offset += used
+            yield zip(getNames(records), records)
+
+
+def fastqIter(infileName, readObject, threads=1, chunkSize=8388608):
+    """file iterator (returns (name, record) tuples, see fastqChunkIter)"""
+    return itertools.chain.from_iterable(fastqChunkIter(infileName, readObject, threads, chunkSize))
+
+def externalSortIter(infileName, readObject, numberOfReads, tmpDir=None, threads=1, mergeBuffer=67108864):
+    """file iterator returning the (name, record) tuples sorted by name (external merge sort).
+    At most <numberOfReads> reads are kept in memory, sorted runs are spilled to temporary files
+    and merged with a heap. The runs are read in chunks of <mergeBuffer> bytes divided by the
+    number of runs (at least 64 kB), so the merge needs about the same memory for any number of runs."""
+    fastqIterator = fastqIter(infileName, readObject, threads)
+    runFileNames = []
+    try:
+        while True:
+            run = list(itertools.islice(fastqIterator, numberOfReads))
+            if not run:
+                break
+            run.sort()
+            if not runFileNames and len(run) < numberOfReads:
+                # everything fits into memory
+                for read in run:
+                    yield read
+                return
+            fd, runFileName = tempfile.mkstemp(prefix="sortedRun_", suffix=".fq.gz", dir=tmpDir)
+            os.close(fd)
+            runFileNames.append(runFileName)
+            with myopen(runFileName, 'w', compresslevel=1) as outfile:
+                for name, record in run:
+                    print >> outfile, record
+            print >> sys.stderr, "sorted %d runs of %s..." % (len(runFileNames), infileName)
+            del run
+        chunkSize = max(65536, mergeBuffer // len(runFileNames))
+        runIters = [fastqIter(fn, readObject, chunkSize=chunkSize) for fn in runFileNames]
+        for read in heapq.merge(*runIters):
+            yield read
+    finally:
+        for runFileName in runFileNames:
+            os.remove(runFileName)
+
 
 if __name__ == "__main__":
     readObject = solidRead if "--solid" in sys.argv else illuminaRead
+    maxReads = int(sys.argv[sys.argv.index("--maxReads")+1]) if "--maxReads" in sys.argv else int(1000000)
+    tmpDir = sys.argv[sys.argv.index("--tmpDir")+1] if "--tmpDir" in sys.argv else None
+    threads = int(sys.argv[sys.argv.index("--threads")+1]) if "--threads" in sys.argv else int(1)
     matched = 0
-    counter = 1
-    with myopen(outfileNameR1, 'w') as outR1, myopen(outfileNameR2, 'w') as outR2, myopen(outfileNameUP) as outUP:
-        iterR1 = fastqIter(infileNameR1, readObject)
-        iterR2 = fastqIter(infileNameR2, readObject)
-        R1 = iterR1.next()
-        R2 = iterR2.next()
-        while True:
-            while R2.name < R1.name:
-                print >> outUP, R2
-                try:
-                    R2 = iterR2.next()
-                    counter += 1
-                except:
-                    break
-            if R1.name == R2.name:
+    counter = 0
+    with myopen(outfileNameR1, 'w', threads=threads) as outR1, \
+         myopen(outfileNameR2, 'w', threads=threads) as outR2, \
+         myopen(outfileNameUP, 'w', threads=threads) as outUP:
+        if "--sort" in sys.argv:
+            iterR1 = externalSortIter(infileNameR1, readObject, maxReads, tmpDir, threads)
+            iterR2 = externalSortIter(infileNameR2, readObject, maxReads, tmpDir, threads)
+        else:
+            iterR1 = fastqIter(infileNameR1, readObject, threads)
+            iterR2 = fastqIter(infileNameR2, readObject, threads)
+        # (name, record) tuples
+        R1 = next(iterR1, None)
+        R2 = next(iterR2, None)
+        while R1 is not None:
+            while R2 is not None and R2[0] < R1[0]:
+                print >> outUP, R2[1]
+                R2 = next(iterR2, None)
+                counter += 1
+            if R2 is not None and R1[0] == R2[0]:
                 matched += 1
-                print >> outR1, R1
-                print >> outR2, R2
-            else:
-                print >> outUP, R1
-            try:
-                R1 = iterR1.next()
+                print >> outR1, R1[1]
+                print >> outR2, R2[1]
+                R2 = next(iterR2, None)
                 counter += 1
-            except:
-                break
-            print >> sys.stderr, "processed %d read ends..." % counter
+            else:
+                print >> outUP, R1[1]
+            R1 = next(iterR1, None)
+            counter += 1
+            if (counter % 1000000) == 0:
+                print >> sys.stderr, "processed %d read ends..." % counter
+        while R2 is not None:
+            print >> outUP, R2[1]
+            R2 = next(iterR2, None)
     print >> sys.stderr, "matched %d pairs" % matched
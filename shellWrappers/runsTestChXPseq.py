@@ -2,16 +2,15 @@
 # -*- coding: utf-8 -*-
 """
 usage:
-python runsTestChXPseq.py bwTest bwControl winLen winType fragSize minWinSize [--subWins 5] [--baseSteps 25] [--pCut 0.00001] [--diffCut 1] [--largeMode 0]
+python runsTestChXPseq.py bwTest bwControl winLen winType fragSize minWinSize [--subWins 5] [--baseSteps 25] [--pCut 0.00001] [--diffCut 1] [--largeMode 0] [--binMode point]
 
 install dependencies:
 sudo easy_install ngslib
-sudo pip install skidmarks
 btw - this is for deeptools:
 sudo pip install pyBigWig
 
 arguments:
-\t-bwTest: bigWig of the test sample
+\t-bwTest: bigWig of the test sample (a comma-separated list with --batch)
 \t-bwControl: bigWig of the control sample
 \t-winLen: size of the smoothing window (e.g. 147)
 \t\tnote: must be an odd integer
@@ -28,6 +27,32 @@ optional arguments:
 --diffCut (1): cutoff for the LFC
 --largeMode (0): take only every Xth base BEFORE smoothing
                  zero means to take all bases (logically it's the same as 1 but faster)
+--binMode (point): how the Xth bases of --largeMode are taken: point (the coverage of every
+                 Xth base), mean (the mean coverage of the X bases) or zoom (the mean taken
+                 from the zoom levels of the bigWig, needs pyBigWig)
+--processes (1): number of chromosomes processed in parallel (largest first),
+                 the output is written in the order of the chromosome names
+--tileSize (10000000): the coverage is read and smoothened in tiles of about this many bases
+--cacheDir: keep the (binned) coverage of the bigWigs in this directory, later runs with the
+            same bigWigs, --largeMode and --binMode read it from there (default: no cache)
+--cacheSize (10): maximal size of the cache directory in GB
+--prefetch (1): number of coverage tiles read ahead by a background thread while the current
+            ones are tested (each one more tile in memory), 0 reads a tile only when needed
+--merge: write the overlapping regions with the same sign already joined (like
+         processChXPrunsTest.R): chrom, start, end, mean pValue, mean averageDifference
+--bed outFile testName refName: write the joined regions as BED (like processChXPrunsTest.R):
+         chrom, start, end, <testName|refName><number>, 100*averageDifference
+--sweep outPrefix: winLen, --pCut and --diffCut can be comma-separated lists, every combination
+         is written to <outPrefix>.RT.<winLen>_<winType>_<fragSize>_<minWinSize>_<subWins>_
+         <baseSteps>_<pCut>_<diffCut>_<largeMode>_<binMode>.txt (and .bed with --bed, its outFile
+         is not used then). The coverage is read once for all window lengths and the tested
+         windows are shared by all cutoffs. Without --sweep only the first values are used.
+--batch outPrefix: bwTest is a comma-separated list of test samples that are all compared to
+         bwControl, the control coverage is read once per chromosome and the samples are
+         tested together. The results of a sample go to <outPrefix>_<sample>.RT.<winLen>_...txt
+         (named like --sweep, with --bed also .bed with the sample as testName; the outFile
+         and the testName of --bed are not used then), <sample> is the file name without .bw.
+         The coverage of all samples is held for a tile, a smaller --tileSize needs less memory.
 
 notes:
 \t-the bigWigs need to be normalized:
@@ -37,9 +62,11 @@ notes:
 import sys
 
 try:
-    bwTest = sys.argv[1]
+    bwTests = sys.argv[1].split(",")
+    bwTest = bwTests[0]
     bwControl = sys.argv[2]
-    winLen = int(sys.argv[3])
+    winLens = [int(x) for x in sys.argv[3].split(",")]
+    winLen = winLens[0]
     winType = sys.argv[4]
     fragSize = int(sys.argv[5])
     minWinSize = int(sys.argv[6])
@@ -51,15 +78,36 @@ except:
 
 COMPsubWins = int(sys.argv[sys.argv.index("--subWins")+1]) if "--subWins" in sys.argv else int(5)
 COMPbaseSteps = int(sys.argv[sys.argv.index("--baseSteps")+1]) if "--baseSteps" in sys.argv else int(25)
-COMPpCutoff = float(sys.argv[sys.argv.index("--pCut")+1]) if "--pCut" in sys.argv else float(.00001)
-COMPdiffCutoff = float(sys.argv[sys.argv.index("--diffCut")+1]) if "--diffCut" in sys.argv else int(1)
+COMPpCutoffs = [float(x) for x in sys.argv[sys.argv.index("--pCut")+1].split(",")] if "--pCut" in sys.argv else [float(.00001)]
+COMPdiffCutoffs = [float(x) for x in sys.argv[sys.argv.index("--diffCut")+1].split(",")] if "--diffCut" in sys.argv else [int(1)]
+COMPpCutoff = COMPpCutoffs[0]
+COMPdiffCutoff = COMPdiffCutoffs[0]
 COMPlargeMode = int(sys.argv[sys.argv.index("--largeMode")+1]) if "--largeMode" in sys.argv else int(25)
-
-import wWigIO
-from ngslib import BigWigFile
-from skidmarks import wald_wolfowitz, serial_test
+binMode = sys.argv[sys.argv.index("--binMode")+1] if "--binMode" in sys.argv else "point"
+processes = int(sys.argv[sys.argv.index("--processes")+1]) if "--processes" in sys.argv else int(1)
+tileSize = int(sys.argv[sys.argv.index("--tileSize")+1]) if "--tileSize" in sys.argv else int(1e7)
+cacheDir = sys.argv[sys.argv.index("--cacheDir")+1] if "--cacheDir" in sys.argv else None
+cacheSize = float(sys.argv[sys.argv.index("--cacheSize")+1])*1e9 if "--cacheSize" in sys.argv else float(10e9)
+prefetchDepth = int(sys.argv[sys.argv.index("--prefetch")+1]) if "--prefetch" in sys.argv else int(1)
+mergeRegions = "--merge" in sys.argv
+if "--bed" in sys.argv:
+    bedFile, bedTestName, bedRefName = sys.argv[sys.argv.index("--bed")+1:sys.argv.index("--bed")+4]
+else:
+    bedFile = None
+sweepPrefix = sys.argv[sys.argv.index("--sweep")+1] if "--sweep" in sys.argv else None
+batchPrefix = sys.argv[sys.argv.index("--batch")+1] if "--batch" in sys.argv else None
+if batchPrefix is None:
+    bwTests = bwTests[:1]
+if sweepPrefix is None:
+    winLens = winLens[:1]
+    COMPpCutoffs = COMPpCutoffs[:1]
+    COMPdiffCutoffs = COMPdiffCutoffs[:1]
+
+from coverageChXPseq import bigWigConnection, prefetch, sampleName, inChromOrder
 import numpy as np
+import itertools
 import math
+import multiprocessing
 
 # classes and functions
 def intersect(a, b):
@@ -81,7 +129,140 @@ def sign01(x):
     else:
         return 0
 
-sign01vec = np.vectorize(sign01)
+def sign01vec(x):
+    """sign01 for arrays (1 for positive values and +0, 0 for negative values, -0 and nan)."""
+    x = np.asarray(x)
+    return ((x > 0) | ((x == 0) & ~np.signbit(x))).astype(np.int8)
+
+
+normalCdf = np.frompyfunc(lambda z: 0.5 * math.erfc(-z / math.sqrt(2.)), 1, 1)
+
+
+def waldWolfowitz(diff):
+    """Wald-Wolfowitz runs test (normal approximation) on a 0/1 array.
+    Same as skidmarks.wald_wolfowitz, but a 2-D array is tested row by row.
+    return: a dict with p, z, mean, sd and n_runs (arrays for 2-D input),
+    p is nan if there are only zeroes (or ones)"""
+    x = np.atleast_2d(diff)
+    N = float(x.shape[1])
+    nRuns = np.count_nonzero(np.diff(x, axis=1), axis=1) + 1
+    n = np.count_nonzero(x, axis=1).astype(float)
+    out = runsTestStats(nRuns, n, N)
+    if np.ndim(diff) == 1:
+        out = dict((k, v[0]) for k, v in out.items())
+    return out
+
+
+def runsTestStats(nRuns, n, N):
+    """The Wald-Wolfowitz statistics given the number of runs, of ones and of values
+    (arrays of floats, or N a float for all)."""
+    m = N - n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ER = ((2 * n * m) / N) + 1
+        VR = (2 * n * m * (2 * n * m - N)) / (N**2 * (N - 1))
+        SD = np.sqrt(VR)
+        Z = (nRuns - ER) / SD
+    return {'z': Z, 'mean': ER, 'sd': SD, 'p': normalCdf(Z).astype(float), 'n_runs': nRuns}
+
+
+class windowStats(object):
+    """Average difference and runs test of windows [lo, hi) of a pair of coverage arrays,
+    taking every baseSteps-th value of a window. The differences, the signs and the
+    cumulative numbers of ones and of sign changes are computed once per phase
+    (lo % baseSteps) and shared by all windows. Tested windows are remembered, so
+    overlapping regions (e.g. the offsets of a fragment) do not test them again.
+    testCov can also hold several test samples (a row per sample), every window is then
+    tested for all of them at once and the results are arrays (see sample)."""
+    def __init__(self, contCov, testCov, baseSteps=25):
+        self.contCov = contCov
+        self.testCov = testCov
+        self.baseSteps = baseSteps
+        self.phases = {}
+        self.known = {}
+
+    def getPhase(self, phase):
+        """The differences, the cumulative number of ones and of sign changes of a phase."""
+        if phase not in self.phases:
+            realDiff = self.testCov[..., phase::self.baseSteps] - self.contCov[phase::self.baseSteps]
+            diff = sign01vec(realDiff)
+            size = diff.shape[-1]
+            ones = np.zeros(diff.shape[:-1] + (size + 1,), dtype=np.int64)
+            np.cumsum(diff, axis=-1, out=ones[..., 1:])
+            changes = np.zeros(diff.shape[:-1] + (max(size, 1),), dtype=np.int64)
+            np.cumsum(diff[..., 1:] != diff[..., :-1], axis=-1, out=changes[..., 1:])
+            self.phases[phase] = (realDiff, ones, changes)
+        return self.phases[phase]
+
+    def test(self, windows):
+        """windows: a list of (lo, hi), (None, None) for a window without coverage values
+        (the arrays are zeroes then).
+        return: a list of (aveDiff, p), p is nan if there are only zeroes (or ones)"""
+        todo = [w for w in set(windows) if w not in self.known]
+        samples = self.testCov.shape[:-1]
+        aveDiffs = []
+        nRuns = np.zeros((len(todo),) + samples)
+        n = np.zeros((len(todo),) + samples)
+        N = np.zeros((len(todo),) + samples)
+        for i, (lo, hi) in enumerate(todo):
+            if lo is None:
+                aveDiffs.append(np.zeros(samples)[()])
+                nRuns[i], n[i], N[i] = 1, 1, 1
+                continue
+            phase = lo % self.baseSteps
+            realDiff, ones, changes = self.getPhase(phase)
+            first = (lo - phase) // self.baseSteps
+            size = -(-(hi - lo) // self.baseSteps)
+            aveDiffs.append(realDiff[..., first:first+size].mean(axis=-1))
+            nRuns[i] = changes[..., first+size-1] - changes[..., first] + 1
+            n[i] = ones[..., first+size] - ones[..., first]
+            N[i] = size
+        pVals = runsTestStats(nRuns, n, N)['p']
+        for w, aveDiff, p in itertools.izip(todo, aveDiffs, pVals):
+            self.known[w] = (aveDiff, p)
+        return [self.known[w] for w in windows]
+
+    def sample(self, k):
+        """The windowStats of the k-th test sample (of several)."""
+        return sampleStats(self, k)
+
+
+class sampleStats(object):
+    """One test sample of a windowStats of several test samples, it is used like a windowStats."""
+    def __init__(self, stats, k):
+        self.stats = stats
+        self.k = k
+        self.contCov = stats.contCov
+        self.testCov = stats.testCov[k]
+
+    def test(self, windows):
+        """See windowStats.test, the windows are tested for all samples of the windowStats."""
+        return [(aveDiff[self.k], p[self.k]) for aveDiff, p in self.stats.test(windows)]
+
+
+def mergeDirectional(regions, gap=0):
+    """Join overlapping regions with the same sign of the average difference, like
+    f.join.overlapping.fragments.directional of processChXPrunsTest.R: a region starts a new
+    one if it starts more than <gap> bases after the end of the previous region or if the
+    sign of its average difference is different.
+    regions: (chrom, start, end, p, aveDiff) sorted by chrom, start and end
+    yield: (chrom, start, end, count, mean p, mean aveDiff)"""
+    cur = None
+    for chrom, start, end, p, aveDiff in regions:
+        if (cur is not None and chrom == cur[0] and (start - prevEnd) <= gap and
+                np.sign(aveDiff) == np.sign(prevAveDiff)):
+            cur[1] = min(cur[1], start)
+            cur[2] = max(cur[2], end)
+            cur[3] += 1
+            cur[4] += p
+            cur[5] += aveDiff
+        else:
+            if cur is not None:
+                yield cur[0], cur[1], cur[2], cur[3], cur[4]/cur[3], cur[5]/cur[3]
+            cur = [chrom, start, end, 1, p, aveDiff]
+        prevEnd = end
+        prevAveDiff = aveDiff
+    if cur is not None:
+        yield cur[0], cur[1], cur[2], cur[3], cur[4]/cur[3], cur[5]/cur[3]
 
 
 class genomicRegion(object):
@@ -134,200 +315,307 @@ class genomicRegion(object):
                                                       winLen, winType, largeMode)
         return None
 
-    def compare(self, subWins=5, baseSteps=25, pCutoff=.00001, diffCutoff=1, minSize=1e3):
+    def compare(self, subWins=5, baseSteps=25, pCutoff=.00001, diffCutoff=1, minSize=1e3,
+                stats=None, offset=0):
         """Compare the control and the test sample.
         subWins: number of windows to split a region into
         baseSteps: to avoid some of the autocorrelation given by the reads, take only every
         baseSteps-th base
         pCutoff: the p-value cutoff to either follow up or not
         minSize: minimal size of a region to still be tested
+        stats: a windowStats shared with other regions, the coverage of this region starts
+        at <offset> in its arrays (default: a windowStats of this region)
+        The windows are tested level by level, only the significant ones are split into the
+        next level. The result is the same as testing the windows recursively: a window is
+        reported if none of its sub-windows is, and its average difference is above diffCutoff.
         return: a list of significant regions"""
-        sigRegs = []
-        if self.size < minSize:
-            return sigRegs
-        realDiff = self.testCov[::baseSteps] - self.contCov[::baseSteps]
-        self.aveDiff = realDiff.mean()
-        diff = sign01vec(realDiff)
-        try:
-            testRes = wald_wolfowitz(diff)
-            self.p = testRes['p']
-        except ZeroDivisionError:  # this means that there are only zeroes (or ones)
-            self.p = 0
-            if abs(self.aveDiff) > diffCutoff:
-                sigRegs = [self]
-            return sigRegs
-        if self.p > pCutoff:
-            return sigRegs
-        nextSize = int(self.size/subWins)
-        for startPoint in xrange(self.start, self.end, nextSize):
-            relStart = startPoint-self.start
-            relEnd = relStart+nextSize
-            reg = genomicRegion(self.chrom, startPoint, startPoint+nextSize,
-                                self.contCov[relStart:relEnd], self.testCov[relStart:relEnd])
-            sigRegs.extend(reg.compare(subWins, baseSteps, pCutoff, diffCutoff, minSize))
-        if not sigRegs and abs(self.aveDiff) > diffCutoff:
-            sigRegs = [self]
-        return sigRegs
-
-
-class bigWigConnection(object):
-    """A bigWig handler"""
-    def __init__(self, path):
-        self.path = path
-
-    def getChromSizesWigIO(self):
-        wWigIO.open(self.path)
-        out = wWigIO.getChromSize(self.path)
-        out = dict(zip(out[0], out[1]))
-        wWigIO.close(self.path)
-        return out
-
-    def getChromSizesNGSLIB(self):
-        infile = BigWigFile(self.path)
-        out = infile.chromSizes()
-        out = dict(zip(out[0], out[1]))
-        infile.close()
-        return out
-
-    def smoothCoverageSave(self, covArray, winLen=147, winType="flat"):
-        """Calculate smoothened coverage, see http://www.scipy.org/Cookbook/SignalSmooth.
-        Note that winLen should be an odd integer. winType == flat meand moving average."""
-        x = covArray
-        if x.size < winLen:
-            raise ValueError("Input vector needs to be bigger than window size.")
-        if x.ndim != 1:
-            raise ValueError("Smooth only accepts 1 dimension arrays.")
-        if window not in ["flat", "hanning", "hamming", "bartlett", "blackman"]:
-            raise ValueError("Valid winTypes are flat, hanning, hamming, bartlett, and blackman.")
-        s = np.r_[2 * x[0] - x[winLen:1:-1], x, 2 * x[-1] - x[-1:-winLen:-1]]
-        if window == "flat":
-            w = np.ones(winLen, 'd')
-        else:
-            w = eval("np." + window + "(winLen)")
-        y = np.convolve(w / w.sum(), s, mode="same")
-        return y[winLen-1:-winLen+1]
-
-    def smoothCoverageFlat(self, covArray, winLen=147):
-        """Calculate smoothened coverage using moving average.
-        Note that winLen should be an odd integer."""
-        if (winLen % 2) == 0:
-            winLen += 1
-        x = covArray
-        s = np.r_[2 * x[0] - x[winLen:1:-1], x, 2 * x[-1] - x[-1:-winLen:-1]]
-        w = np.ones(winLen, 'd')
-        y = np.convolve(w / w.sum(), s, mode="same")
-        return y[winLen-1:-winLen+1]
-
-    def smoothCoverageSpec(self, covArray, winLen=147, winType="blackman"):
-        """Calculate smoothened coverage with a specified window type.
-        Note that winLen should be an odd integer."""
-        if (winLen % 2) == 0:
-            winLen += 1
-        x = covArray
-        s = np.r_[2 * x[0] - x[winLen:1:-1], x, 2 * x[-1] - x[-1:-winLen:-1]]
-        w = eval("np." + window + "(winLen)")
-        y = np.convolve(w / w.sum(), s, mode="same")
-        return y[winLen-1:-winLen+1]
-
-    def getRawCoverage(self, chrom, start, end):
-        """Retrieve an array with the genome coverage."""
-        out = np.zeros(end-start)
-        infile = BigWigFile(self.path)
-        wigs = infile.fetch(chrom, start, end)
-        for wig in wigs:
-            out[wig[0]-start:wig[1]-start] = wig[2]
-        infile.close()
-        return out
-
-    def getSmoothCoverage(self, chrom, start, end, winLen=147, winType="flat"):
-        """Retrieve an array with the smoothened genome coverage.
-        CHECK/TODO: one might have to extend the coverage array first"""
-        raw = self.getRawCoverage(chrom, start, end)
-        if winType == "flat":
-            out = self.smoothCoverageFlat(raw, winLen)
-        else:
-            out = self.smoothCoverageSpec(raw, winLen, winType)
-        return out
-
-    def getRawCoverageLargeMode(self, chrom, start, end, largeMode=10):
-        """Retrieve an array with the genome coverage."""
-        out = np.zeros(end-start)
-        infile = BigWigFile(self.path)
-        wigs = infile.fetch(chrom, start, end)
-        for wig in wigs:
-            out[wig[0]-start:wig[1]-start] = wig[2]
-        infile.close()
-        return out[::largeMode]
-
-    def getSmoothCoverageLargeMode(self, chrom, start, end, winLen=147, winType="flat", largeMode=10):
-        """Retrieve an array with the smoothened genome coverage.
-        CHECK/TODO: one might have to extend the coverage array first"""
-        winLen = int(winLen/largeMode)
-        raw = self.getRawCoverageLargeMode(chrom, start, end, largeMode)
-        if winType == "flat":
-            out = self.smoothCoverageFlat(raw, winLen)
-        else:
-            out = self.smoothCoverageSpec(raw, winLen, winType)
-        return out
-
-if (__name__ == "__main__") and not COMPlargeMode:
-    contBW = bigWigConnection(bwControl)
-    testBW = bigWigConnection(bwTest)
-    contCS = contBW.getChromSizesNGSLIB()
-    testCS = testBW.getChromSizesNGSLIB()
-    if len(contCS) != len(testCS):
-        print >> sys.stderr, "WARNING: The two files have different numbers of chromosomes."
-    chromsToCheck = intersect(contCS.keys(), testCS.keys())
-    for chrom in chromsToCheck:
-        contSize = contCS[chrom]
-        testSize = testCS[chrom]
-        size = max([contSize, testSize])    # in case of Raffaella and Giody I used only contSize
-        print >> sys.stderr, chrom, size
-        if size < winLen:
-            print >> sys.stderr, "skipping it because of the size"
+        if stats is None:
+            stats = windowStats(self.contCov, self.testCov, baseSteps)
+            offset = 0
+        # node: [start, end, lo, hi, children, p, aveDiff, tested]
+        nodes = [[self.start, self.end, offset, offset + self.contCov.size, [], 1, 0, False]]
+        level = [0]
+        while level:
+            level = [i for i in level if nodes[i][1] - nodes[i][0] >= minSize]
+            results = stats.test([(nodes[i][2], nodes[i][3]) for i in level])
+            nextLevel = []
+            for i, (aveDiff, p) in itertools.izip(level, results):
+                node = nodes[i]
+                node[6] = aveDiff
+                node[7] = True
+                if np.isnan(p):  # this means that there are only zeroes (or ones)
+                    node[5] = 0
+                    continue
+                node[5] = p
+                if p > pCutoff:
+                    continue
+                nodeStart, nodeEnd, lo, hi = node[:4]
+                nextSize = int((nodeEnd - nodeStart)/subWins)
+                for startPoint in xrange(nodeStart, nodeEnd, nextSize):
+                    relStart = startPoint - nodeStart
+                    childLo = min(lo + relStart, hi)
+                    childHi = min(lo + relStart + nextSize, hi)
+                    if childLo >= childHi:
+                        childLo, childHi = None, None
+                    node[4].append(len(nodes))
+                    nextLevel.append(len(nodes))
+                    nodes.append([startPoint, startPoint + nextSize, childLo, childHi,
+                                  [], 1, 0, False])
+            level = nextLevel
+        # children are always after their parent, so going backwards every node
+        # sees the results of its children
+        results = [None] * len(nodes)
+        for i in xrange(len(nodes) - 1, -1, -1):
+            nodeStart, nodeEnd, lo, hi, children, p, aveDiff, tested = nodes[i]
+            sigRegs = []
+            if tested:
+                for child in children:
+                    sigRegs.extend(results[child])
+                    results[child] = None
+                if (not sigRegs) and (abs(aveDiff) > diffCutoff) and (p <= pCutoff):
+                    if i == 0:
+                        reg = self
+                    elif lo is None:
+                        reg = genomicRegion(self.chrom, nodeStart, nodeEnd)
+                    else:
+                        reg = genomicRegion(self.chrom, nodeStart, nodeEnd,
+                                            stats.contCov[lo:hi], stats.testCov[lo:hi])
+                    reg.p = p
+                    reg.aveDiff = aveDiff
+                    sigRegs = [reg]
+            results[i] = sigRegs
+        if nodes[0][7]:
+            self.p = nodes[0][5]
+            self.aveDiff = nodes[0][6]
+        return results[0]
+
+
+def scanChromosome(chrom, size, contBW, testBWs, winLens=None, cutoffs=None):
+    """Compare all fragments (at all offsets) of a chromosome.
+    The smoothened coverage is streamed in tiles (see bigWigConnection.iterCoverageTiles),
+    the values are the same as for the whole chromosome, and the regions get views on a
+    buffer that only holds the tiles the current fragments need. The offsets of a fragment
+    share one windowStats, so the signs are computed once and windows are tested once.
+    testBWs: a list of bigWigConnections of test samples, the control coverage is read once
+    and the differences, signs and runs of all samples are computed together (a row per sample)
+    winLens: the window lengths (default: [winLen]), the coverage is read once for all
+    cutoffs: a list of (pCut, diffCut) (default: the ones of the command line), all
+    cutoffs share the tested windows
+    yield: (index of the test sample, index of the window length, index of the cutoffs,
+    significant region)"""
+    if winLens is None:
+        winLens = [winLen]
+    if cutoffs is None:
+        cutoffs = [(COMPpCutoff, COMPdiffCutoff)]
+    if COMPlargeMode:
+        step = COMPlargeMode
+    else:
+        step = 1
+    # the next tiles are read while the fragments of the current ones are tested
+    tiles = prefetch(itertools.izip(contBW.iterCoverageTiles(chrom, size, tileSize, winLens, winType, COMPlargeMode, binMode),
+                                    *[testBW.iterCoverageTiles(chrom, size, tileSize, winLens, winType, COMPlargeMode, binMode)
+                                      for testBW in testBWs]), prefetchDepth)
+    bufFirst = 0
+    contCovs = [np.zeros(0) for curLen in winLens]
+    testCovs = [np.zeros((len(testBWs), 0)) for curLen in winLens]
+    for start in xrange(0, size, fragSize):
+        if (start % 1e7) == 0:
+            print >> sys.stderr, chrom, start
+        # drop the bins left of the current fragment
+        drop = -(-start // step) - bufFirst
+        contCovs = [contCov[drop:] for contCov in contCovs]
+        testCovs = [testCov[:, drop:] for testCov in testCovs]
+        bufFirst += drop
+        regions = []
+        for offSet in xrange(0, minWinSize, int(minWinSize/5)):
+            regStart = start + offSet
+            regEnd = min(regStart + fragSize, size)
+            if regStart >= regEnd:
+                continue
+            regions.append((regStart, regEnd, -(-regStart // step) - bufFirst, -(-regEnd // step) - bufFirst))
+        if not regions:
             continue
-        for start in xrange(0, size, fragSize):
-            if (start % 1e7) == 0:
-                print >> sys.stderr, chrom, start
-            for offSet in xrange(0, minWinSize, int(minWinSize/5)):
-                print >> sys.stderr, "extracting region"
-                reg = genomicRegion(chrom, start+offSet, start+offSet+fragSize)
-                print >> sys.stderr, "smoothening coverage"
-                reg.addSmoothContCov(contBW, winLen, winType)
-                reg.addSmoothTestCov(testBW, winLen, winType)
-                print >> sys.stderr, "searching segments"
-                sigRegs = reg.compare(COMPsubWins, COMPbaseSteps, COMPpCutoff, COMPdiffCutoff, minWinSize)
-                for sigReg in sigRegs:
-                    print sigReg
-
-if (__name__ == "__main__") and COMPlargeMode:
+        spanEnd = max([last for regStart, regEnd, first, last in regions])
+        while contCovs[0].size < spanEnd:
+            # a StopIteration would silently end this generator (and drop the chromosome)
+            curTiles = next(tiles, None)
+            if curTiles is None:
+                raise ValueError("The coverage tiles of %s end at bin %d, the fragments need %d bins."
+                                 % (chrom, bufFirst + contCovs[0].size, bufFirst + spanEnd))
+            contCovs = [np.concatenate([contCov, tile]) for contCov, tile in zip(contCovs, curTiles[0][1])]
+            testCovs = [np.concatenate([testCov, np.vstack([testTiles[i] for tileFirst, testTiles in curTiles[1:]])], axis=1)
+                        for i, testCov in enumerate(testCovs)]
+        for i, (contCov, testCov) in enumerate(zip(contCovs, testCovs)):
+            stats = windowStats(contCov[:spanEnd], testCov[:, :spanEnd], COMPbaseSteps)
+            for regStart, regEnd, first, last in regions:
+                for k in xrange(len(testBWs)):
+                    for j, (pCutoff, diffCutoff) in enumerate(cutoffs):
+                        reg = genomicRegion(chrom, regStart, regEnd, contCov[first:last], testCov[k, first:last])
+                        if last > first:
+                            sigRegs = reg.compare(COMPsubWins, COMPbaseSteps, pCutoff, diffCutoff, minWinSize,
+                                                  stats.sample(k), first)
+                        else:
+                            sigRegs = reg.compare(COMPsubWins, COMPbaseSteps, pCutoff, diffCutoff, minWinSize)
+                        for sigReg in sigRegs:
+                            yield k, i, j, sigReg
+    tiles.close()
+
+
+workerState = {}
+
+
+def initWorker(contPath, testPaths):
+    """Pool initializer: every worker process gets its own bigWigConnections."""
+    workerState["cont"] = bigWigConnection(contPath, cacheDir=cacheDir, cacheSize=cacheSize)
+    workerState["tests"] = [bigWigConnection(testPath, cacheDir=cacheDir, cacheSize=cacheSize)
+                            for testPath in testPaths]
+
+
+def scanChromosomeTask(args):
+    """Pool worker: scan a chromosome with the bigWigConnections of the worker.
+    return: the chromosome and for every test sample and setting (window length, pCut, diffCut)
+    the lines of its significant regions, the joined regions (or None) and the number of regions"""
+    chrom, size = args
+    cutoffs = list(itertools.product(COMPpCutoffs, COMPdiffCutoffs))
+    numSettings = len(winLens) * len(cutoffs)
+    sigRegs = [[] for setting in xrange(len(workerState["tests"]) * numSettings)]
+    for k, i, j, reg in scanChromosome(chrom, size, workerState["cont"], workerState["tests"], winLens, cutoffs):
+        sigRegs[k*numSettings+i*len(cutoffs)+j].append((reg.chrom, reg.start, reg.end, reg.p, reg.aveDiff))
+    out = []
+    for k, regs in enumerate(sigRegs):
+        if size < winLens[(k % numSettings) // len(cutoffs)]:
+            # skipped because of the size, as in a run with only this window length
+            regs = []
+        lines = ['\t'.join([reg[0], str(reg[1]), str(reg[2]), str(reg[3]), str(reg[4])]) for reg in regs]
+        merged = None
+        if mergeRegions or bedFile:
+            merged = list(mergeDirectional(sorted(regs, key=lambda x: (x[1], x[2]))))
+        if mergeRegions:
+            lines = ['\t'.join([reg[0], str(reg[1]), str(reg[2]), str(reg[4]), str(reg[5])])
+                     for reg in merged]
+        out.append((lines, merged, len(regs)))
+    return chrom, out
+
+
+def sweepFileNames(prefix):
+    """The output names (without extension) of all settings of a sweep, in the order of
+    scanChromosomeTask. The values are written as given on the command line."""
+    def given(option, default):
+        return sys.argv[sys.argv.index(option)+1] if option in sys.argv else default
+    names = []
+    for curLen in sys.argv[3].split(","):
+        for pCut in given("--pCut", "0.00001").split(","):
+            for diffCut in given("--diffCut", "1").split(","):
+                names.append("%s.RT.%s" % (prefix, "_".join([curLen, winType, sys.argv[5], sys.argv[6],
+                                                             given("--subWins", "5"), given("--baseSteps", "25"),
+                                                             pCut, diffCut, given("--largeMode", "25"), binMode])))
+    return names
+
+
+def writeBed(merged, outFile, testSample, refSample, numRegions):
+    """Write the joined regions as BED and report some numbers (like processChXPrunsTest.R):
+    the regions with a positive average difference are named testSample1, testSample2, ...
+    the ones with a negative refSample1, ... and the score is 100*averageDifference."""
+    print >> sys.stderr, "Loaded", numRegions, "regions."
+    print >> sys.stderr, len(merged), "regions remain after merging overlapping regions."
+    if merged:
+        aveDiff = np.abs([reg[5] for reg in merged])
+        regSize = np.array([reg[2] - reg[1] for reg in merged])
+        print >> sys.stderr, "Distribution of the average difference:"
+        print >> sys.stderr, np.percentile(aveDiff, range(0, 101, 10))
+        print >> sys.stderr, "Distribution of the region size:"
+        print >> sys.stderr, np.percentile(regSize, range(0, 101, 10))
+        cutoff = np.percentile(aveDiff, 90)
+        print >> sys.stderr, ((regSize > 5000) | (aveDiff > cutoff)).sum(), \
+            "regions are > 5 kb or have an absolute average difference above %g." % cutoff
+    numPos = 0
+    numNeg = 0
+    with open(outFile, "w") as out:
+        for chrom, start, end, count, p, aveDiff in merged:
+            if aveDiff > 0:
+                numPos += 1
+                name = testSample + str(numPos)
+            elif aveDiff < 0:
+                numNeg += 1
+                name = refSample + str(numNeg)
+            else:
+                name = "toReplace"
+            out.write("%s\t%d\t%d\t%s\t%.15g\n" % (chrom, start, end, name, aveDiff*100))
+    return None
+
+
+if (__name__ == "__main__"):
     contBW = bigWigConnection(bwControl)
-    testBW = bigWigConnection(bwTest)
     contCS = contBW.getChromSizesNGSLIB()
-    testCS = testBW.getChromSizesNGSLIB()
-    if len(contCS) != len(testCS):
-        print >> sys.stderr, "WARNING: The two files have different numbers of chromosomes."
-    chromsToCheck = intersect(contCS.keys(), testCS.keys())
-    for chrom in chromsToCheck:
+    contBW.close()
+    chroms = contCS.keys()
+    testCSs = []
+    for curTest in bwTests:
+        testBW = bigWigConnection(curTest)
+        testCS = testBW.getChromSizesNGSLIB()
+        testBW.close()
+        if len(contCS) != len(testCS):
+            print >> sys.stderr, "WARNING: The two files have different numbers of chromosomes."
+        chroms = intersect(chroms, testCS.keys())
+        testCSs.append(testCS)
+    chromSizes = {}
+    for chrom in sorted(chroms):
         contSize = contCS[chrom]
-        testSize = testCS[chrom]
+        testSize = max([testCS[chrom] for testCS in testCSs])
         size = max([contSize, testSize])    # in case of Raffaella and Giody I used only contSize
         print >> sys.stderr, chrom, size
-        if size < winLen:
+        if size < min(winLens):
             print >> sys.stderr, "skipping it because of the size"
             continue
-        for start in xrange(0, size, fragSize):
-            if (start % 1e7) == 0:
-                print >> sys.stderr, chrom, start
-            for offSet in xrange(0, minWinSize, int(minWinSize/5)):
-                print >> sys.stderr, "extracting region"
-                reg = genomicRegion(chrom, start+offSet, start+offSet+fragSize)
-                print >> sys.stderr, "smoothening coverage"
-                reg.addSmoothContCovLargeMode(contBW, winLen, winType, COMPlargeMode)
-                reg.addSmoothTestCovLargeMode(testBW, winLen, winType, COMPlargeMode)
-                print >> sys.stderr, "searching segments"
-                sigRegs = reg.compare(COMPsubWins, COMPbaseSteps, COMPpCutoff, COMPdiffCutoff, minWinSize)
-                for sigReg in sigRegs:
-                    print sigReg
-    
-
+        chromSizes[chrom] = size
+    chromsToCheck = sorted(chromSizes.keys())
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initWorker, (bwControl, bwTests))
+        tasks = sorted(chromSizes.items(), key=lambda x: x[1], reverse=True)
+        results = pool.imap_unordered(scanChromosomeTask, tasks)
+    else:
+        pool = None
+        initWorker(bwControl, bwTests)
+        results = itertools.imap(scanChromosomeTask, [(chrom, chromSizes[chrom]) for chrom in chromsToCheck])
+    if batchPrefix is not None:
+        # a file per test sample and setting, in the order of scanChromosomeTask
+        names = []
+        bedTestNames = []
+        for curTest in bwTests:
+            curNames = sweepFileNames("%s_%s" % (batchPrefix, sampleName(curTest)))
+            if sweepPrefix is None:
+                curNames = curNames[:1]
+            names.extend(curNames)
+            bedTestNames.extend([sampleName(curTest)] * len(curNames))
+        outFiles = [open(name + ".txt", "w") for name in names]
+        bedFiles = [name + ".bed" for name in names]
+    elif sweepPrefix is None:
+        outFiles = [sys.stdout]
+        bedFiles = [bedFile]
+    else:
+        names = sweepFileNames(sweepPrefix)
+        outFiles = [open(name + ".txt", "w") for name in names]
+        bedFiles = [name + ".bed" for name in names]
+    if batchPrefix is None:
+        bedTestNames = [bedTestName for outFile in outFiles] if bedFile else []
+    allMerged = [[] for outFile in outFiles]
+    numRegions = [0 for outFile in outFiles]
+    for chrom, settings in inChromOrder(results, chromsToCheck):
+        for k, (lines, merged, numChromRegions) in enumerate(settings):
+            for line in lines:
+                print >> outFiles[k], line
+            if bedFile:
+                allMerged[k].extend(merged)
+                numRegions[k] += numChromRegions
+    for k, outFile in enumerate(outFiles):
+        if outFile is not sys.stdout:
+            outFile.close()
+        if bedFile:
+            writeBed(allMerged[k], bedFiles[k], bedTestNames[k], bedRefName, numRegions[k])
+    if pool is not None:
+        pool.close()
+        pool.join()
+    else:
+        workerState["cont"].close()
+        for testBW in workerState["tests"]:
+            testBW.close()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Regression tests for runsTestChXPseq.py, edgeTestChXPseq.py and their coverage module
+coverageChXPseq.py.
+
+usage:
+python -m unittest discover tests
+
+The scripts need their dependencies (ngslib, wWigIO, numpy and for the edge test skidmarks),
+writing the test bigWigs needs pyBigWig. The tests are skipped without them.
+"""
+
+import imp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    import numpy as np
+    import pyBigWig
+except ImportError:
+    pyBigWig = None
+
+scriptDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "shellWrappers")
+# the scripts import coverageChXPseq from their directory
+sys.path.insert(0, scriptDir)
+# chrS is longer than the window (1000) but not longer than its kernel (1001 bases, or 1000
+# bins of 1 and 41 bins of 25 with a kernel of 41 bins with --largeMode 25)
+chromSizes = [("chrA", 200000), ("chrS", 1001)]
+
+
+def writeBigWig(path, scale, seed):
+    """A bigWig with 50 bp intervals of random coverage, higher in the middle of every chromosome."""
+    rs = np.random.RandomState(seed)
+    bw = pyBigWig.open(path, "w")
+    bw.addHeader(chromSizes)
+    for chrom, size in chromSizes:
+        starts = np.arange(0, size, 50)
+        ends = np.minimum(starts + 50, size)
+        values = np.where((starts > size//3) & (starts < size//2), 3*scale, 1.0) * rs.uniform(0.5, 1.5, starts.size)
+        bw.addEntries([chrom]*starts.size, starts.tolist(), ends=ends.tolist(), values=values.tolist())
+    bw.close()
+
+
+def loadScript(name, argv):
+    """Import one of the scripts, they read their arguments when they are imported."""
+    savedArgv = sys.argv
+    sys.argv = [name] + argv
+    try:
+        return imp.load_source(name.replace(".py", ""), os.path.join(scriptDir, name))
+    finally:
+        sys.argv = savedArgv
+
+
+class shortChromosomeTest(unittest.TestCase):
+    """Chromosomes with a size between the window length and the kernel length."""
+    def setUp(self):
+        if pyBigWig is None:
+            self.skipTest("needs numpy and pyBigWig")
+        self.tmpDir = tempfile.mkdtemp()
+        self.testBW = os.path.join(self.tmpDir, "test.bw")
+        self.contBW = os.path.join(self.tmpDir, "cont.bw")
+        writeBigWig(self.testBW, 1.3, 1)
+        writeBigWig(self.contBW, 1.0, 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def loadScript(self, name):
+        try:
+            return loadScript(name, [self.testBW, self.contBW, "1000", "flat", "200000", "1000"])
+        except ImportError as e:
+            self.skipTest("missing dependency: %s" % e)
+
+    def testTiles(self):
+        try:
+            import coverageChXPseq
+        except ImportError as e:
+            self.skipTest("missing dependency: %s" % e)
+        bw = coverageChXPseq.bigWigConnection(self.testBW)
+        for largeMode in [0, 25]:
+            step = largeMode if largeMode else 1
+            numBins = -(-1001 // step)
+            cov = bw.getTiledCoverage("chrS", 1001, 10000000, 1000, "flat", largeMode)
+            self.assertEqual(cov.size, numBins)
+            self.assertTrue(np.all(np.isfinite(cov)))
+        bw.close()
+
+    def testSharedCoverage(self):
+        """Both scripts use the coverage module instead of copies of it."""
+        try:
+            import coverageChXPseq
+        except ImportError as e:
+            self.skipTest("missing dependency: %s" % e)
+        for name in ["runsTestChXPseq.py", "edgeTestChXPseq.py"]:
+            script = self.loadScript(name)
+            for helper in ["bigWigConnection", "prefetch", "sampleName", "inChromOrder"]:
+                self.assertIs(getattr(script, helper), getattr(coverageChXPseq, helper))
+
+    def testRunsTestRegions(self):
+        try:
+            import ngslib
+            import wWigIO
+        except ImportError as e:
+            self.skipTest("missing dependency: %s" % e)
+        for largeMode in ["0", "25"]:
+            out = subprocess.check_output([sys.executable, os.path.join(scriptDir, "runsTestChXPseq.py"),
+                                           self.testBW, self.contBW, "1000", "flat", "200000", "1000",
+                                           "--pCut", "0.5", "--diffCut", "0", "--largeMode", largeMode],
+                                          stderr=open(os.devnull, "w"))
+            chroms = set([line.split("\t")[0] for line in out.splitlines()])
+            self.assertIn("chrS", chroms)
+
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the FASTQ parser (fastqChunkIter) of mergeAndSortSplitPEreads.py and
+mergeSortedSplitPEreads.py, both copies have to parse every file the same way.
+
+usage:
+python -m unittest discover tests
+"""
+
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+scriptDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "shellWrappers")
+scriptNames = ["mergeAndSortSplitPEreads.py", "mergeSortedSplitPEreads.py"]
+
+
+def loadScript(name):
+    """Import one of the scripts, they read their arguments when they are imported."""
+    savedArgv = sys.argv
+    sys.argv = [name, "R1", "R2", "outR1", "outR2", "outUP"]
+    try:
+        return imp.load_source(name.replace(".py", ""), os.path.join(scriptDir, name))
+    finally:
+        sys.argv = savedArgv
+
+
+def makeRecords(num):
+    return ["@read%d_F3 1:N:0:1\n%s\n+\n%s" % (i, "ACGT"[i % 4] * (20 + i % 7), "I" * (20 + i % 7))
+            for i in xrange(num)]
+
+
+class fastqParserTest(unittest.TestCase):
+    def setUp(self):
+        self.scripts = [loadScript(name) for name in scriptNames]
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeFile(self, text):
+        fileName = os.path.join(self.tmpDir, "reads.fq")
+        with open(fileName, "w") as outfile:
+            outfile.write(text)
+        return fileName
+
+    def parse(self, script, fileName, chunkSize, readObject="illuminaRead"):
+        return [read for chunk in script.fastqChunkIter(fileName, getattr(script, readObject),
+                                                        chunkSize=chunkSize)
+                for read in chunk]
+
+    def checkParsed(self, text, records):
+        fileName = self.writeFile(text)
+        expected = [(record.split(" ")[0], record) for record in records]
+        # small chunks split records (and lines) across the chunk boundaries
+        for chunkSize in [1, 7, 64, 1000, 8388608]:
+            for script in self.scripts:
+                self.assertEqual(self.parse(script, fileName, chunkSize), expected)
+
+    def testRecordsAcrossChunks(self):
+        records = makeRecords(50)
+        self.checkParsed("\n".join(records) + "\n", records)
+
+    def testNoFinalNewline(self):
+        records = makeRecords(50)
+        self.checkParsed("\n".join(records), records)
+
+    def testEmptyLinesAtTheEnd(self):
+        records = makeRecords(50)
+        self.checkParsed("\n".join(records) + "\n\n\n\n\n\n", records)
+
+    def testWindowsLineEnds(self):
+        records = makeRecords(50)
+        self.checkParsed("\r\n".join(records) + "\r\n", records)
+
+    def testEmptyLineInTheMiddle(self):
+        records = makeRecords(50)
+        fileName = self.writeFile("\n".join(records[:11]) + "\n\n" + "\n".join(records[11:]) + "\n")
+        offset = len("\n".join(records[:11])) + 1
+        for chunkSize in [1, 7, 64, 1000, 8388608]:
+            for script in self.scripts:
+                with self.assertRaises(ValueError) as cm:
+                    self.parse(script, fileName, chunkSize)
+                self.assertIn("near byte %d" % offset, str(cm.exception))
+
+    def testSolidNames(self):
+        records = makeRecords(20)
+        fileName = self.writeFile("\n".join(records) + "\n")
+        expected = [("_".join(record.split("\n")[0].split("_")[:-1]), record) for record in records]
+        for script in self.scripts:
+            self.assertEqual(self.parse(script, fileName, 64, "solidRead"), expected)
+
+
+if (__name__ == "__main__"):
+    unittest.main()